@@ -0,0 +1,217 @@
+"""Benchmark of the CausalityAgent build and query hot paths on synthetic
+data.
+
+Writes resource files of the configured sizes to a work directory, times a
+cold build of the database from them, then times warm calls of each find_*
+method and reports their p50/p95/p99 latencies and the memory high-water
+mark as JSON, so that runs on different data or SQLite versions can be
+compared.
+
+    python benchmarks/bench_agent.py [--genes 2000] [--output run.json] ...
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+import causality_agent
+
+_causal_rels = ['phosphorylates', 'dephosphorylates',
+                'upregulates-expression', 'downregulates-expression']
+_sif_rels = ['controls-state-change-of', 'controls-expression-of',
+             'in-complex-with', 'controls-phosphorylation-of']
+
+
+def gene_name(ind):
+    return 'G%d' % ind
+
+
+def site_name(rng, gene):
+    residue = rng.choice('STY')
+    return '%s-%s%d%s' % (gene, residue, rng.randrange(1, 1000), residue.lower())
+
+
+def write_causality(path, rng, n_genes, n_rows):
+    with open(os.path.join(path, 'causative-data-centric.sif'), 'w') as fp:
+        for _ in range(n_rows):
+            uris = ' '.join('http://pathwaycommons.org/pc2/Catalysis_%032x' % rng.getrandbits(128)
+                            for _ in range(rng.randint(1, 4)))
+            fp.write('%s\t%s\t%s\t%s\n' % (site_name(rng, gene_name(rng.randrange(n_genes))),
+                                           rng.choice(_causal_rels),
+                                           site_name(rng, gene_name(rng.randrange(n_genes))),
+                                           uris))
+
+
+def write_correlations(path, rng, n_genes, n_rows):
+    # Correlate the sites of the causality file first so that part of the
+    # correlations is explained
+    with open(os.path.join(path, 'causative-data-centric.sif')) as fp:
+        causal_pairs = [(vals[0], vals[2]) for vals in (line.split('\t') for line in fp)]
+    with open(os.path.join(path, 'PNNL-ovarian-correlations.txt'), 'w') as fp:
+        for ind in range(n_rows):
+            if ind < len(causal_pairs) // 2:
+                site1, site2 = causal_pairs[ind]
+            else:
+                site1 = site_name(rng, gene_name(rng.randrange(n_genes)))
+                site2 = site_name(rng, gene_name(rng.randrange(n_genes)))
+            fp.write('%s\t%s\t%.4f\t%.4g\n' % (site1, site2, rng.uniform(-1, 1), rng.random()))
+
+
+def write_mutsig(path, rng, n_genes):
+    with open(os.path.join(path, 'scores-mutsig.txt'), 'w') as fp:
+        for ind in range(n_genes):
+            vals = [str(ind + 1), gene_name(ind), 'synthetic gene'] + ['0'] * 14 + \
+                   ['%.6e' % rng.random() ** 4, '%.6e' % rng.random()]
+            fp.write('\t'.join(vals) + '\n')
+
+
+def write_sif(path, rng, n_genes, n_rows):
+    with open(os.path.join(path, 'PC.sif'), 'w') as fp:
+        for _ in range(n_rows):
+            fp.write('%s\t%s\t%s\n' % (gene_name(rng.randrange(n_genes)), rng.choice(_sif_rels),
+                                       gene_name(rng.randrange(n_genes))))
+
+
+def write_mutex(path, rng, n_genes, n_rows):
+    with open(os.path.join(path, 'ranked-groups.txt'), 'w') as fp:
+        for _ in range(n_rows):
+            genes = [gene_name(rng.randrange(n_genes)) for _ in range(rng.choice([2, 3]))]
+            fp.write('%s\t0.0\t%s\n' % (rng.random() ** 8, '\t'.join(genes)))
+
+
+def write_resources(path, args):
+    rng = random.Random(args.seed)
+    write_causality(path, rng, args.genes, args.causality)
+    write_correlations(path, rng, args.genes, args.correlations)
+    write_mutsig(path, rng, args.genes)
+    write_sif(path, rng, args.genes, args.sif)
+    write_mutex(path, rng, args.genes, args.mutex)
+
+
+def percentiles(durations):
+    """Return the nearest-rank p50, p95 and p99 of durations in ms"""
+    durations = sorted(durations)
+    stats = {}
+    for percent in (50, 95, 99):
+        rank = max(int(len(durations) * percent / 100.0 + 0.5), 1)
+        stats['p%d_ms' % percent] = durations[rank - 1] * 1e3
+    return stats
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def query_benchmarks(ca, rng, n_genes):
+    """Return the benchmarked calls by name, each a function of a random
+    gene"""
+    def genes(count):
+        return [gene_name(rng.randrange(n_genes)) for _ in range(count)]
+
+    return {
+        'find_causality': lambda gene: ca.find_causality({'source': {'id': gene},
+                                                          'target': {'id': genes(5)}}),
+        'find_causal_paths': lambda gene: ca.find_causal_paths({'source': {'id': gene},
+                                                                'target': {'id': genes(1)[0]}}),
+        'find_causality_targets': lambda gene: ca.find_causality_targets({'id': gene,
+                                                                          'rel': 'phosphorylates'}),
+        'find_causality_targets_modulates': lambda gene: ca.find_causality_targets({'id': gene,
+                                                                                    'rel': 'modulates'}),
+        'find_causality_targets_many': lambda gene: ca.find_causality_targets_many(genes(20),
+                                                                                   'phosphorylates'),
+        'find_next_correlation': lambda gene: ca.find_next_correlation(gene, 'bench'),
+        'find_mut_sig': ca.find_mut_sig,
+        'find_mut_sig_many': lambda gene: ca.find_mut_sig_many(genes(20)),
+        'find_common_upstreams': lambda gene: ca.find_common_upstreams(genes(3)),
+        'find_mutex': ca.find_mutex,
+    }
+
+
+def run(args):
+    path = args.work_dir or tempfile.mkdtemp(prefix='causality-bench-')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    write_resources(path, args)
+    db_files = [os.path.join(path, 'network.db'), os.path.join(path, 'pnnl-dataset.db')]
+    for db_file in db_files:
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+
+    start = time.time()
+    ca = causality_agent.CausalityAgent(path, build_processes=args.build_processes)
+    build_time = time.time() - start
+    report = {
+        'sizes': dict((name, getattr(args, name))
+                      for name in ('genes', 'causality', 'correlations', 'sif', 'mutex')),
+        'build_processes': args.build_processes,
+        'sqlite_version': sqlite3.sqlite_version,
+        'python_version': sys.version.split()[0],
+        'build': {'total_s': build_time,
+                  'tables_s': ca.build_times,
+                  'db_size_mb': sum(os.path.getsize(db_file) for db_file in db_files) / (1024.0 * 1024.0),
+                  'max_rss_mb': max_rss_mb()},
+        'queries': {},
+    }
+
+    rng = random.Random(args.seed + 1)
+    for name, query in sorted(query_benchmarks(ca, rng, args.genes).items()):
+        # One untimed call to load the in-memory graphs and warm the cache
+        query(gene_name(rng.randrange(args.genes)))
+        durations = []
+        for _ in range(args.queries):
+            gene = gene_name(rng.randrange(args.genes))
+            start = time.time()
+            query(gene)
+            durations.append(time.time() - start)
+        report['queries'][name] = percentiles(durations)
+    report['max_rss_mb'] = max_rss_mb()
+
+    if not args.work_dir and not args.keep:
+        shutil.rmtree(path)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--genes', type=int, default=2000)
+    parser.add_argument('--causality', type=int, default=20000,
+                        help='rows of causative-data-centric.sif')
+    parser.add_argument('--correlations', type=int, default=100000,
+                        help='rows of PNNL-ovarian-correlations.txt')
+    parser.add_argument('--sif', type=int, default=200000, help='rows of PC.sif')
+    parser.add_argument('--mutex', type=int, default=5000, help='rows of ranked-groups.txt')
+    parser.add_argument('--queries', type=int, default=500, help='timed calls per method')
+    parser.add_argument('--build-processes', type=int, default=1,
+                        help='processes parsing the resource files during the build')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--work-dir', help='directory for the resource files and database, '
+                                           'kept after the run')
+    parser.add_argument('--keep', action='store_true', help='keep the temporary work directory')
+    parser.add_argument('--output', help='file to write the JSON report to, instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=1, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=1, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Micro-benchmark of string-built IN lists against the json_each bound
+lists of CausalityAgent.select.
+
+String-built queries have a new SQL text for every gene list, so SQLite
+parses and plans each of them. The json_each queries have one text per
+query shape and reuse the prepared statement from the statement cache.
+
+    python benchmarks/bench_query_layer.py [n_relations] [n_repeats]
+"""
+import sys
+import time
+import json
+import random
+import sqlite3
+
+batch_sizes = [1, 5, 20, 100, 500]
+
+
+def make_db(n_relations, n_genes):
+    cadb = sqlite3.connect(':memory:')
+    cadb.execute("CREATE TABLE Causality(Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Rel TEXT, UriStr TEXT)")
+    rows = (('G%d' % random.randrange(n_genes), 'S1S', 'G%d' % random.randrange(n_genes), 'S2S',
+             random.choice(['phosphorylates', 'is-phosphorylated-by']), '')
+            for _ in range(n_relations))
+    cadb.executemany("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?)", rows)
+    cadb.execute("CREATE INDEX Causality_Id1_Rel ON Causality(Id1, Rel)")
+    cadb.commit()
+    return cadb
+
+
+def string_built(cadb, genes):
+    id_str = ", ".join("'" + gene + "'" for gene in genes)
+    query = "SELECT * FROM Causality WHERE Rel = ? AND Id1 IN (" + id_str + ") ORDER BY rowid"
+    return cadb.execute(query, ('phosphorylates',)).fetchall()
+
+
+def json_bound(cadb, genes):
+    query = "SELECT * FROM Causality WHERE Rel = ? AND Id1 IN " \
+            "(SELECT value FROM json_each(?)) ORDER BY rowid"
+    return cadb.execute(query, ('phosphorylates', json.dumps(genes))).fetchall()
+
+
+def time_queries(cadb, query_fun, gene_lists):
+    start = time.time()
+    for genes in gene_lists:
+        query_fun(cadb, genes)
+    return (time.time() - start) / len(gene_lists)
+
+
+def main(n_relations=200000, n_repeats=200):
+    n_genes = n_relations // 10
+    cadb = make_db(n_relations, n_genes)
+    print('%8s %16s %16s %8s' % ('genes', 'string (us)', 'json_each (us)', 'ratio'))
+    for batch_size in batch_sizes:
+        gene_lists = [['G%d' % random.randrange(n_genes) for _ in range(batch_size)]
+                      for _ in range(n_repeats)]
+        string_time = time_queries(cadb, string_built, gene_lists)
+        json_time = time_queries(cadb, json_bound, gene_lists)
+        print('%8d %16.1f %16.1f %8.2f' % (batch_size, string_time * 1e6, json_time * 1e6,
+                                           string_time / json_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,244 +1,1351 @@
 import re
 import os
+import json
+import time
+import shutil
 import sqlite3
+import hashlib
+import tempfile
 import logging
+import threading
+import collections
+from collections import OrderedDict
+import multiprocessing
+from contextlib import contextmanager
+import causality_graph
+import causality_metrics
+import correlation_store
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where builds are not guarded against other
+    # processes
+    fcntl = None
+
+logger = logging.getLogger('CausalityAgent')
+
+# Pragmas used while bulk loading the tables. The database is rebuilt from
+# the resource files if anything goes wrong, so durability is not needed.
+_build_pragmas = ['PRAGMA journal_mode = OFF',
+                  'PRAGMA synchronous = OFF',
+                  'PRAGMA cache_size = -262144',  # 256 MB
+                  'PRAGMA temp_store = MEMORY']
+
+_default_pragmas = ['PRAGMA journal_mode = DELETE',
+                    'PRAGMA synchronous = FULL',
+                    'PRAGMA cache_size = -2000',
+                    'PRAGMA temp_store = DEFAULT']
+
+# Indexes on the columns the find_* methods filter on, created once each
+# table is loaded
+_table_indexes = {
+    'Causality_Relations': [('Causality_Relations_Id1_Rel', 'Id1, Rel'),
+                            ('Causality_Relations_Id2_Rel', 'Id2, Rel')],
+    'Correlations': [('Correlations_Id1_Id2', 'Id1, Id2, PSite1, PSite2'),
+                     ('Correlations_Id2', 'Id2')],
+    'MutSig': [('MutSig_Id', 'Id, Level')],
+    'Ranked_Correlations': [('Ranked_Gene', 'Gene, Explained, AbsCorr DESC')],
+    'Sif_Relations': [('Sif_Relations_Rel_Id2', 'Rel, Id2, Id1')],
+    'Mutex_Members': [('Mutex_Members_Gene', 'Gene, GroupId')],
+}
+
+# Bumped whenever the layout of the tables changes, which forces a full
+# rebuild of existing databases
+_schema_version = 8
+
+# Tables of the network database shared by all datasets
+_network_tables = ['Causality', 'MutSig', 'Sif_Relations', 'Mutex_Groups', 'Mutex_Members']
+
+# Tables of the database of each correlation dataset
+_dataset_tables = ['Correlations', 'Unexplained_Correlations', 'Explained_Correlations',
+                   'Ranked_Correlations']
+
+# Groups of network tables built and made available together when the
+# database is built in the background, in priority order: the small tables
+# first, then the causality lookups, then the large Sif_Relations table.
+# The datasets are built between the second and the third group, as their
+# correlations are classified against the Causality table. Derived tables
+# share the group of the tables they are derived from so that a build
+# interrupted between groups leaves a consistent manifest behind.
+_network_build_groups = [['MutSig', 'Mutex_Groups', 'Mutex_Members'],
+                         ['Causality'],
+                         ['Sif_Relations']]
+
+# Resource files each network table is read from
+_table_sources = {
+    'Causality': ['causative-data-centric.sif'],
+    'MutSig': ['scores-mutsig.txt'],
+    'Sif_Relations': ['PC.sif'],
+    'Mutex_Groups': ['ranked-groups.txt'],
+}
+
+# Tables derived from other tables, rebuilt whenever those are
+_table_dependencies = {
+    'Unexplained_Correlations': ['Correlations'],
+    'Explained_Correlations': ['Correlations'],
+    'Ranked_Correlations': ['Correlations'],
+    'Mutex_Members': ['Mutex_Groups'],
+}
+
+# Correlation files of the datasets, keyed by dataset name
+_default_datasets = {'pnnl': 'PNNL-ovarian-correlations.txt'}
+_default_dataset = 'pnnl'
+
+# Dataset names are used as the schema names of the attached databases,
+# quoted with _schema since they may be SQL keywords
+_dataset_name = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# SQLite attaches at most 10 databases to a connection by default
+_max_datasets = 10
+
+# os.replace is atomic on all platforms but only exists in Python 3
+_replace = getattr(os, 'replace', os.rename)
+
+
+def file_hash(file_path):
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_entry(file_path, old_entry=None):
+    """Return the (hash, size, mtime) manifest entry of a resource file.
+
+    The file is only hashed if its size or modification time differ from
+    old_entry.
+    """
+    stat = os.stat(file_path)
+    if old_entry is not None and old_entry[1:] == (stat.st_size, stat.st_mtime):
+        return old_entry
+    return (file_hash(file_path), stat.st_size, stat.st_mtime)
+
+
+def read_manifest(db_file):
+    """Return the manifest entries of a database keyed by source file, or
+    None if the database is missing, unreadable or of another schema version.
+    """
+    if not os.path.isfile(db_file):
+        return None
+    cadb = sqlite3.connect(db_file)
+    try:
+        version = cadb.execute("PRAGMA user_version").fetchone()[0]
+        if version != _schema_version:
+            return None
+        rows = cadb.execute("SELECT Source, Hash, Size, MTime FROM Manifest").fetchall()
+    except sqlite3.DatabaseError:
+        return None
+    finally:
+        cadb.close()
+    return dict((row[0], tuple(row[1:])) for row in rows)
+
+
+def write_manifest(cadb, entries):
+    with cadb:
+        cur = cadb.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS Manifest(Source TEXT PRIMARY KEY, Hash TEXT, "
+                    "Size INTEGER, MTime REAL)")
+        cur.execute("DELETE FROM Manifest")
+        cur.executemany("INSERT INTO Manifest VALUES(?, ?, ?, ?)",
+                        ((source,) + tuple(entry) for source, entry in entries.items()))
+    cadb.execute("PRAGMA user_version = %d" % _schema_version)
+
+
+@contextmanager
+def file_lock(file_path):
+    """Hold an exclusive lock on file_path.lock, so that the processes
+    sharing a resource directory build its files one at a time"""
+    try:
+        fp = open(file_path + '.lock', 'a')
+    except (IOError, OSError):
+        # Nothing can be built in a read-only resource directory either
+        yield
+        return
+    with fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def _is_file_name(file_name):
+    """Return whether file_name names a file of the resource directory,
+    without any directory part that could lead out of it"""
+    return file_name not in ('', '.', '..') and '/' not in file_name and '\\' not in file_name
+
+
+def _schema(name):
+    """Quote the name of a dataset as the schema name of its database"""
+    return '"%s"' % name
+
+
+def dataset_sources(correlation_file):
+    """Return the resource files of the tables of a dataset, keyed by
+    table. The Explained flags of the correlations are read off the
+    causality file."""
+    return {'Correlations': [correlation_file, 'causative-data-centric.sif']}
+
+
+# Expands a list bound with CausalityAgent.select in an IN clause
+_json_list = "(SELECT value FROM json_each(?))"
+
+# Results per page of the paged find_* methods
+_default_page_size = 100
+
+# Correlation walks kept at most, the least recently used dropped first
+_max_cursors = 10000
+
+_opposite_rel = {
+    'phosphorylates': 'is-phosphorylated-by',
+    'dephosphorylates': 'is-dephosphorylated-by',
+    'upregulates-expression': 'expression-is-upregulated-by',
+    'downregulates-expression': 'expression-is-downregulated-by',
+}
+
+_forward_rel = dict((opposite, rel) for rel, opposite in _opposite_rel.items())
+
+# Columns of the Causality view, selected from Causality_Relations for
+# each relationship and for its opposite relationship, which comes right
+# after it in Seq order
+_relation_columns = "Id1, PSite1, Id2, PSite2, Rel, UriIds, Res1, Pos1, Res2, Pos2, IndraJson, " \
+                    "2 * rowid - 1 AS Seq"
+_opposite_columns = "Id2, PSite2, Id1, PSite1, CASE Rel " + \
+                    " ".join("WHEN '%s' THEN '%s'" % rels for rels in sorted(_opposite_rel.items())) + \
+                    " END, UriIds, Res2, Pos2, Res1, Pos1, IndraJson, 2 * rowid"
+
+# Common prefix of the provenance URIs, stored without it
+_uri_prefix = 'http://pathwaycommons.org/pc2/'
+
+
+def _targets_filter(param, after=None):
+    """Return the filter of the causal relationships of type param['rel']
+    from the genes param['id'] for _causality_query, only of those after
+    the one of Seq after in the Causality view if after is given"""
+    genes = _as_list(param.get('id'))
+    rowid = _merge_rowid(genes)
+    if len(genes) == 1:
+        gene_match, gene_args = " = ?", (genes[0],)
+    else:
+        gene_match, gene_args = " IN " + _json_list, (genes,)
+    rel = param.get('rel')
+    if rel.upper() == "MODULATES":
+        where, args = "Id1" + gene_match, gene_args
+        opposite_where, opposite_args = "Id2" + gene_match, gene_args
+    else:
+        where, args = "Rel = ? AND Id1" + gene_match, (rel,) + gene_args
+        opposite_where, opposite_args = "Rel = ? AND Id2" + gene_match, (_forward_rel.get(rel),) + gene_args
+    if after is not None:
+        # Seq is 2 * rowid - 1 for the relationships and 2 * rowid for
+        # their opposite ones
+        where += " AND " + rowid + " > ?"
+        args += ((after + 1) // 2,)
+        opposite_where += " AND " + rowid + " > ?"
+        opposite_args += (after // 2,)
+    return (where, args), (opposite_where, opposite_args)
+
+
+def _merge_rowid(genes):
+    """Return the rowid expression the causal relationships of genes are
+    bounded and merged on. The rows of one gene and relation are read off
+    the indexes in rowid order. For several genes, the + keeps SQLite from
+    scanning the whole table in rowid order instead of searching the
+    indexes gene by gene."""
+    return "rowid" if len(genes) == 1 else "+rowid"
+
+
+def _causality_query(columns, causality_filter):
+    """Return the query of columns of the rows of the Causality view
+    selected by causality_filter, along with its arguments.
+
+    The filter is a (where, args) pair on the rows of Causality_Relations
+    for the relationships themselves and one for their opposite
+    relationships. SQLite does not push conditions holding subqueries,
+    like the IN _json_list clauses, down into the arms of the view, so the
+    arms are written out here to be searched through the indexes.
+    """
+    (where, args), (opposite_where, opposite_args) = causality_filter
+    query = "SELECT " + columns + " FROM (" \
+            "SELECT " + _relation_columns + " FROM Causality_Relations WHERE " + where + " UNION ALL " \
+            "SELECT " + _opposite_columns + " FROM Causality_Relations WHERE " + opposite_where + ")"
+    return query, args + opposite_args
+
+
+def _ordered_targets_query(param, after=None, condition=None):
+    """Return the query of the rows of the Causality view of the causal
+    relationships of param that match condition, after the one of Seq after
+    if given, in Seq order, along with its arguments.
+
+    The arms are merged on the rowid and arm of each row, which end the
+    rows after Seq. For one gene and relation, the arms are read off the
+    indexes in that order, so the rows are streamed without being sorted
+    and a LIMIT stops the reading. Otherwise the selected rows of each arm
+    are sorted first.
+    """
+    (where, args), (opposite_where, opposite_args) = _targets_filter(param, after)
+    if condition is not None:
+        where += " AND " + condition
+        opposite_where += " AND " + condition
+    rowid = _merge_rowid(_as_list(param.get('id')))
+    query = "SELECT " + _relation_columns + ", " + rowid + " AS RelationId, 0 AS Arm " \
+            "FROM Causality_Relations WHERE " + where + " UNION ALL " \
+            "SELECT " + _opposite_columns + ", " + rowid + ", 1 FROM Causality_Relations " \
+            "WHERE " + opposite_where + " ORDER BY RelationId, Arm"
+    return query, args + opposite_args
+
+
+def _next_ranked_query(dataset, after):
+    """Return the query of the next row of the ranked correlations of a
+    gene in a dataset, after the (AbsCorr, rowid) key of the last row if
+    after is set.
+
+    The rows are read off the Ranked_Gene index in order. The key is
+    compared as AbsCorr <= ? AND (AbsCorr < ? OR rowid > ?) rather than as
+    a disjunction of the two cases, which SQLite would run as two index
+    searches whose rows it then sorts.
+    """
+    query = "SELECT Id1, PSite1, Id2, PSite2, Corr, PVal, AbsCorr, rowid " \
+            "FROM %s.Ranked_Correlations WHERE Gene = ? AND Explained = ? " % _schema(dataset)
+    if after:
+        query += "AND AbsCorr <= ? AND (AbsCorr < ? OR rowid > ?) "
+    return query + "ORDER BY AbsCorr DESC, rowid LIMIT 1"
+
+
+def _page_params(param):
+    """Return the page size of a paged request and the Seq after which its
+    page starts. Raises ValueError if they are not valid."""
+    try:
+        page_size = int(param.get('pageSize') or _default_page_size)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page size: %s' % param.get('pageSize'))
+    if page_size < 1:
+        raise ValueError('Invalid page size: %d' % page_size)
+    page_token = param.get('pageToken')
+    try:
+        after = int(page_token) if page_token else -1
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page token: %s' % page_token)
+    return page_size, after
+
+
+# Significance of the genes missing from MutSig
+_mut_sig_unknown = "unknown"
+
+
+def _mut_sig_level(p_val):
+    if p_val < 0.01:
+        return "highly significant"
+    elif p_val < 0.05:
+        return "significant"
+    else:
+        return "not significant"
+
+
+def _as_list(ids):
+    return ids if isinstance(ids, list) else [ids]
+
+
+def _split_site(id_str):
+    """Split a PC formatted id such as AKT1-S473s into gene and site"""
+    id_arr = id_str.upper().split('-')
+    if len(id_arr) > 1:
+        return id_arr[0], id_arr[1]
+    return id_arr[0], ' '
+
+
+def _strip_uri(uri):
+    return uri[len(_uri_prefix):] if uri.startswith(_uri_prefix) else uri
+
+
+def _expand_uri(uri):
+    return uri if '://' in uri else _uri_prefix + uri
+
+
+# Row generators for the resource files, streamed into executemany
+def _causality_rows(lines):
+    """Generate the rows of the causal relationships, with their
+    provenance URIs as a JSON list stripped of _uri_prefix. The opposite
+    relationships are added by the Causality view."""
+    for line in lines:
+        vals = line.rstrip('\n').split('\t')
+        id1, p_site1 = _split_site(vals[0])
+        id2, p_site2 = _split_site(vals[2])
+        rel = vals[1]
+        uris = json.dumps([_strip_uri(uri) for uri in vals[3].split(' ') if uri])
+
+        res1, pos1 = _parse_sites(p_site1)
+        res2, pos2 = _parse_sites(p_site2)
+        row = (id1, p_site1, id2, p_site2, rel, uris, res1, pos1, res2, pos2)
+        # The INDRA statement of the opposite relationship is the same
+        yield row + (_row_indra_json(row),)
+
+
+def _parse_sites(p_site):
+    """Parse a PC formatted site string such as T185TY187Y into its comma
+    separated residues and positions, here T,Y and 185,187"""
+    sites = re.findall('([TYS][0-9]+)[TYS]', p_site)
+    return ','.join(site[0] for site in sites), ','.join(site[1:] for site in sites)
+
+
+def _row_indra_json(row):
+    """The INDRA statement JSON of a Causality row, or None for relations
+    that have no INDRA statement"""
+    try:
+        return json.dumps(make_indra_json(CausalityAgent.row_to_causality(row)))
+    except (KeyError, IndexError):
+        return None
+
+
+def _log_without_indra(left_out, total):
+    if left_out:
+        logger.info('Left out %d of %d causal relationships without an INDRA statement' %
+                    (left_out, total))
+
+
+def _correlation_rows(lines):
+    for line in lines:
+        if line.find('/') > -1:  # incorrectly formatted strings
+            continue
+        vals = line.split('\t')
+        id1, p_site1 = _split_site(vals[0])
+        id2, p_site2 = _split_site(vals[1])
+        corr = float(vals[2].rstrip('\n'))
+        p_val = float(vals[3].rstrip('\n'))
+        yield (id1, p_site1, id2, p_site2, corr, p_val)
+
+
+def _mutsig_rows(lines):
+    for line in lines:
+        vals = line.split('\t')
+        p_val = float(vals[17])
+        yield (vals[1], p_val, _mut_sig_level(p_val))
+
+
+def _sif_rows(lines):
+    for line in lines:
+        vals = line.split('\t')
+        yield (vals[0].upper(), (vals[2].rstrip('\n')).upper(), vals[1])
+
+
+def _mutex_rows(lines):
+    for line in lines:
+        vals = line.rstrip('\n').split('\t')
+        yield (float(vals[0]), json.dumps(vals[2:]))
+
+
+# Row generators of the resource file each table is read from, the first
+# of its sources
+_table_parsers = {
+    'Causality': _causality_rows,
+    'Correlations': _correlation_rows,
+    'MutSig': _mutsig_rows,
+    'Sif_Relations': _sif_rows,
+    'Mutex_Groups': _mutex_rows,
+}
+
+# Size in bytes of the chunks resource files are split into for parsing in
+# a process pool
+_build_chunk_size = 1 << 22
+
+
+def _chunk_ranges(file_path, chunk_size):
+    """Split a file into (start, end) byte ranges of about chunk_size"""
+    size = os.path.getsize(file_path)
+    starts = list(range(0, size, chunk_size)) or [0]
+    return [(start, min(start + chunk_size, size)) for start in starts]
+
+
+def _read_lines(file_path, start, end):
+    """Generate the lines of a file starting within the byte range
+    [start, end)"""
+    with open(file_path, 'rb') as fp:
+        if start > 0:
+            # Skip the line started in the previous range
+            fp.seek(start - 1)
+            fp.readline()
+        pos = fp.tell()
+        while pos < end:
+            line = fp.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line if isinstance(line, str) else line.decode('utf-8')
+
+
+def _parse_chunk(parse_rows, file_path, start, end):
+    """Parse the lines in a byte range of a file into a list of rows. Runs
+    in the processes of the build pool."""
+    return list(parse_rows(_read_lines(file_path, start, end)))
+
+
+class _ParsedChunks(object):
+    """Rows of a resource file parsed chunk by chunk in a process pool,
+    generated in file order.
+
+    At most window chunks are queued or held parsed ahead of the reader,
+    so that a large file is never held in memory as a whole.
+    """
+    def __init__(self, pool, parse_rows, file_path, window):
+        self.pool = pool
+        self.parse_rows = parse_rows
+        self.file_path = file_path
+        self.ranges = collections.deque(_chunk_ranges(file_path, _build_chunk_size))
+        self.jobs = collections.deque()
+        for _ in range(window):
+            self.submit()
+
+    def submit(self):
+        if self.ranges:
+            start, end = self.ranges.popleft()
+            self.jobs.append(self.pool.apply_async(_parse_chunk, (self.parse_rows, self.file_path, start, end)))
+
+    def __iter__(self):
+        while self.jobs:
+            job = self.jobs.popleft()
+            self.submit()
+            for row in job.get():
+                yield row
+
+
+def _read_only_uri(db_file):
+    return 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(db_file))
+
+
+def connect_read_only(db_file, attached=()):
+    """Open a read-only connection to a built database.
+
+    Databases are only ever replaced as a whole, never rewritten in place
+    (except for the Manifest table which readers do not use), so the file
+    can be opened as immutable and SQLite skips all locking. attached are
+    (schema name, database file) pairs of further built databases to
+    attach to the connection the same way.
+    """
+    try:
+        cadb = sqlite3.connect(_read_only_uri(db_file), uri=True, check_same_thread=False)
+        uri_filenames = True
+    except TypeError:
+        # Python 2 has no URI filenames
+        cadb = sqlite3.connect(db_file, check_same_thread=False)
+        cadb.execute("PRAGMA query_only = ON")
+        uri_filenames = False
+    for name, attached_file in attached:
+        cadb.execute("ATTACH DATABASE ? AS %s" % _schema(name),
+                     (_read_only_uri(attached_file) if uri_filenames else attached_file,))
+    return cadb
+
+
+class ConnectionPool(object):
+    """Read-only connections to a database, one per thread.
+
+    sqlite3 connections may only be used from the thread that opened
+    them, so every thread gets its own and queries from different threads
+    run in parallel.
+    """
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        # Databases attached to the connections, keyed by schema name. They
+        # are attached once their file exists.
+        self.attached = {}
+
+        # Bumped whenever a database file is replaced
+        self.generation = 0
+
+    def get(self):
+        cadb = getattr(self.local, 'cadb', None)
+        if cadb is not None and self.local.generation != self.generation:
+            # Still open on the replaced file
+            with self.lock:
+                self.connections.remove(cadb)
+            cadb.close()
+            cadb = None
+        if cadb is None:
+            with self.lock:
+                attached = [(name, attached_file) for name, attached_file in sorted(self.attached.items())
+                            if os.path.isfile(attached_file)]
+            cadb = connect_read_only(self.db_file, attached)
+            self.local.cadb = cadb
+            self.local.generation = self.generation
+            with self.lock:
+                self.connections.append(cadb)
+        return cadb
+
+    def refresh(self):
+        """Make every thread reopen its connection on its next query"""
+        with self.lock:
+            self.generation += 1
+
+    def attach(self, name, db_file):
+        """Attach db_file as schema name to the connections, reopened on
+        their next query"""
+        with self.lock:
+            self.attached[name] = db_file
+            self.generation += 1
+
+    def detach(self, name):
+        with self.lock:
+            self.attached.pop(name, None)
+            self.generation += 1
+
+    def close(self):
+        with self.lock:
+            for cadb in self.connections:
+                cadb.close()
+            self.connections = []
+        self.local = threading.local()
+
+
+class CorrelationCursor(object):
+    """Position of a session in the ranked correlations of a gene.
+
+    The explained correlations are walked first, then the unexplained ones.
+    The position in each walk is the (AbsCorr, rowid) key of the last row
+    returned from Ranked_Correlations, or the offset of the next row in the
+    walk when the correlation store is used.
+    """
+    def __init__(self):
+        self.positions = {True: None, False: None}
+        self.lock = threading.Lock()
+
+
+def make_indra_json(causality):
+    """Convert causality response to indra format
+        Causality format is (id1, res1, pos1, id2,res2, pos2, rel)"""
+    # TODO: Do these special cases still need to be handled?
+    '''
+    if causality.pos1 == '':
+        causality.pos1 = None
+    if causality.pos2 == '':
+        causality.pos2 = None
+    if causality.res1 == '':
+        causality.res1 = None
+    if causality.res2 == '':
+        causality.res2 = None
+    '''
+
+    causality['rel'] = causality['rel'].upper()
+
+    indra_relation_map = {
+        "PHOSPHORYLATES": "Phosphorylation",
+        "IS-PHOSPHORYLATED-BY": "Phosphorylation",
+        "DEPHOSPHORYLATES": "Dephosphorylation",
+        "IS-DEPHOSPHORYLATED-BY": "Dephosphorylation",
+        "UPREGULATES-EXPRESSION": "IncreaseAmount",
+        "EXPRESSION-IS-UPREGULATED-BY": "IncreaseAmount",
+        "DOWNREGULATES-EXPRESSION": "DecreaseAmount",
+        "EXPRESSION-IS-DOWNREGULATED-BY": "DecreaseAmount"
+    }
+
+    rel_type = indra_relation_map[causality['rel']]
+
+    s, t = ('2', '1') if 'IS' in causality['rel'] else ('1', '2')
+    subj, obj = ('enz', 'sub') if 'PHOSPHO' in causality['rel'] else \
+                ('subj', 'obj')
+
+    if "PHOSPHO" in causality['rel']:  # phosphorylation
+        indra_json = {'type': rel_type,
+                      subj: {'name': causality['id%s' % s],
+                             'mods': causality['mods%s' % s]},
+                      obj: {'name': causality['id%s' % t]},
+                      'residue': causality['mods%s' % t][0]['residue'],
+                      'position': causality['mods%s' % t][0]['position']}
+    else:  # expression
+        indra_json = {'type': rel_type,
+                      subj: {'name': causality['id%s' % s]},
+                      obj: {'name': causality['id%s' % t]}}
+    return indra_json
 
-class CausalityAgent:
-    def __init__(self, path):
-        self.corr_ind = 0
-        self.causality_ind = 0
 
-        db_file = os.path.join(path, 'pnnl-dataset.db')
-        if os.path.isfile(db_file):
-            self.cadb = sqlite3.connect(db_file)
+class CausalityAgent:
+    def __init__(self, path, use_sif_graph=True, lazy=False, on_ready=None,
+                 use_correlation_store=False, build_processes=1, datasets=None,
+                 default_dataset=_default_dataset):
+        """Open the databases of the resource files in path, building the
+        tables that are missing or out of date.
+
+        The network tables are kept in one database shared by all
+        datasets, and the correlations of each dataset in a database of
+        their own attached to it. datasets maps the name of each dataset
+        to its correlation file, by default the PNNL ovarian dataset.
+        Correlations are looked up in default_dataset unless a dataset is
+        named.
+
+        With lazy set, the tables are built in a background thread and the
+        constructor returns right away; table_ready tells which tables can
+        be queried. on_ready is called once all tables are built.
+
+        With use_correlation_store set and numpy installed, correlations are
+        looked up in a memory-mapped CorrelationStore instead of SQLite.
+
+        With build_processes above 1, the resource files are parsed in a
+        pool of that many processes while the tables are built.
+        """
+        # Answer common upstream queries from the in-memory Sif_Relations
+        # graph shared by the agents of the process
+        self.use_sif_graph = use_sif_graph
+        # Correlation cursors keyed by (session id, dataset, gene), least
+        # recently used first
+        self.cursors = OrderedDict()
+        self.max_cursors = _max_cursors
+        self.cursor_lock = threading.Lock()
+        self.build_times = {}
+        # Connection the tables are written through while building, by one
+        # build at a time
+        self.build_db = None
+        self.build_lock = threading.RLock()
+        self.build_processes = build_processes
+        # Pool the resource files are parsed in while building, and the
+        # chunks of the files being parsed keyed by file and parser, kept
+        # by the thread building
+        self.build_local = threading.local()
+        # Tables that are built and can be queried, the tables of a dataset
+        # named as dataset.table
+        self.ready_tables = set()
+        self.ready_condition = threading.Condition()
+        # Error of the background build if it failed, after which the tables
+        # that are not ready never will be
+        self.build_error = None
+        self.use_correlation_store = use_correlation_store
+        # Correlation stores keyed by dataset
+        self.correlation_stores = {}
+        # Significance levels of the MutSig genes, loaded once the MutSig
+        # table is built
+        self.mut_sig_index = None
+
+        self.path = path
+        self.network_file = os.path.join(path, 'network.db')
+        self.pool = ConnectionPool(self.network_file)
+        self.datasets = {}
+        # Errors of the datasets whose build failed, keyed by name
+        self.failed_datasets = {}
+        self.dataset_lock = threading.Lock()
+        for name, correlation_file in sorted((datasets or _default_datasets).items()):
+            self.register_dataset(name, correlation_file)
+        if default_dataset not in self.datasets:
+            raise ValueError('Unknown default dataset: %s' % default_dataset)
+        self.default_dataset = default_dataset
+        # The datasets added later are built by add_dataset
+        startup_datasets = list(self.datasets)
+
+        if lazy:
+            self.build_thread = threading.Thread(target=self.build_in_background,
+                                                 args=(path, on_ready, startup_datasets))
+            self.build_thread.daemon = True
+            self.build_thread.start()
         else:
-            # create table if it doesn't exist
-            fp = open(db_file, 'w')
-            fp.close()
-            self.cadb = sqlite3.connect(db_file)
-            self.populate_tables(path)
+            self.build_thread = None
+            self.update_databases(path, startup_datasets)
+            if on_ready is not None:
+                on_ready()
 
     def __del__(self):
-        self.cadb.close()
-
-    def populate_tables(self, path):
-        self.populate_correlation_table(path)
-        self.populate_causality_table(path)
-        self.populate_mutsig_table(path)
-        self.populate_unexplained_table()
-        self.populate_explained_table()
-        self.populate_sif_relations_table(path)
-        self.populate_mutex_table(path)
-
-
-    def populate_causality_table(self, path):
-        opposite_rel = {
-            'phosphorylates': 'is-phosphorylated-by',
-            'dephosphorylates': 'is-dephosphorylated-by',
-            'upregulates-expression': 'expression-is-upregulated-by',
-            'downregulates-expression': 'expression-is-downregulated-by',
-        }
-
-        causality_path = os.path.join(path, 'causative-data-centric.sif')
-        causality_file = open(causality_path, 'r')
+        if hasattr(self, 'pool'):
+            self.pool.close()
+
+    @property
+    def cadb(self):
+        """Read-only connection to the database for the calling thread"""
+        return self.pool.get()
+
+    def dataset_file(self, name):
+        return os.path.join(self.path, name + '-dataset.db')
+
+    def register_dataset(self, name, correlation_file):
+        """Add a dataset of the correlations in correlation_file, attached to
+        the connections as schema name once its database is built"""
+        if not _dataset_name.match(name) or name.lower() in ('main', 'temp'):
+            raise ValueError('Invalid dataset name: %s' % name)
+        with self.dataset_lock:
+            if name in self.datasets:
+                raise ValueError('Dataset already exists: %s' % name)
+            if len(self.datasets) >= _max_datasets:
+                raise ValueError('At most %d datasets are supported' % _max_datasets)
+            self.datasets[name] = correlation_file
+            self.failed_datasets.pop(name, None)
+        self.pool.attach(name, self.dataset_file(name))
+
+    def add_dataset(self, name, correlation_file=None, lines=None, on_ready=None):
+        """Add a dataset at runtime and build it in a background thread.
+
+        The correlations are read from correlation_file, the name of a
+        file in the resource directory, or streamed from the iterable lines
+        of a correlation file, which are saved as name-correlations.txt.
+        The rows are classified against the Causality table as they are
+        loaded. Queries of the other datasets go on while it is built, and
+        the dataset can be queried once dataset_status returns 'ready', at
+        which point on_ready is called with its name. Raises ValueError if
+        the name is invalid or taken, or if correlation_file is a path
+        rather than a file name. Returns the thread building the dataset.
+        """
+        if (correlation_file is None) == (lines is None):
+            raise ValueError('Either a correlation file or lines are required')
+        # The file names come from clients, which may only read the files
+        # of the resource directory
+        if correlation_file is not None and not _is_file_name(correlation_file):
+            raise ValueError('Invalid correlation file name: %s' % correlation_file)
+        if correlation_file is None:
+            correlation_file = name + '-correlations.txt'
+        self.register_dataset(name, correlation_file)
+        thread = threading.Thread(target=self.build_dataset_in_background,
+                                  args=(name, lines, on_ready))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def build_dataset_in_background(self, name, lines=None, on_ready=None):
+        try:
+            if lines is not None:
+                file_path = os.path.join(self.path, self.datasets[name])
+                with open(file_path + '.tmp', 'w') as fp:
+                    for line in lines:
+                        fp.write(line)
+                _replace(file_path + '.tmp', file_path)
+            # The correlations are classified against the Causality table
+            if not self.wait_ready(['Causality']):
+                raise RuntimeError('Building the network failed: %s' % self.build_error)
+            self.update_dataset(self.path, name)
+        except Exception as e:
+            logger.exception('Building dataset %s failed' % name)
+            self.remove_dataset(name, e)
+            return
+        if on_ready is not None:
+            on_ready(name)
+
+    def remove_dataset(self, name, error=None):
+        """Detach a dataset whose build failed, remembering the error for
+        dataset_status"""
+        with self.dataset_lock:
+            self.datasets.pop(name, None)
+            self.failed_datasets[name] = str(error)
+        self.pool.detach(name)
+        # Waiters for all tables no longer wait for the dataset
+        with self.ready_condition:
+            self.ready_condition.notify_all()
+
+    def dataset_status(self, name):
+        """Return 'ready', 'building' or 'failed' for a dataset, or None if
+        there is no such dataset"""
+        with self.dataset_lock:
+            if name in self.failed_datasets:
+                return 'failed'
+            if name not in self.datasets:
+                return None
+        return 'ready' if self.table_ready(*self.dataset_tables(name)) else 'building'
+
+    def get_dataset(self, dataset=None):
+        """Return the name of dataset, or of the default dataset if None.
+        Raises ValueError if the dataset does not exist or is not built
+        yet."""
+        if dataset is None:
+            dataset = self.default_dataset
+        status = self.dataset_status(dataset)
+        if status is None:
+            raise ValueError('Unknown dataset: %s' % dataset)
+        if status == 'failed':
+            raise ValueError('Building dataset %s failed: %s' % (dataset, self.failed_datasets.get(dataset)))
+        if status == 'building':
+            raise ValueError('Dataset is still being built: %s' % dataset)
+        return dataset
+
+    def list_datasets(self):
+        """Return the names of the datasets whose tables are built"""
+        with self.dataset_lock:
+            datasets = list(self.datasets)
+        return sorted(name for name in datasets if self.table_ready(*self.dataset_tables(name)))
 
-        with self.cadb:
-            cur = self.cadb.cursor()
+    @staticmethod
+    def dataset_tables(dataset):
+        """Return the names of the tables of a dataset in ready_tables"""
+        return [dataset + '.' + table for table in _dataset_tables]
+
+    def table_ready(self, *tables):
+        """Return whether all given tables are built"""
+        with self.ready_condition:
+            return self.ready_tables.issuperset(tables)
+
+    def build_failed(self, *tables):
+        """Return whether some of the given tables will never be built, as
+        the build of the network or of their dataset failed"""
+        with self.ready_condition:
+            missing = set(tables) - self.ready_tables
+            if self.build_error is not None and any('.' not in table for table in missing):
+                return True
+        with self.dataset_lock:
+            return any(table.split('.')[0] in self.failed_datasets for table in missing if '.' in table)
+
+    def all_tables(self):
+        """Return the names of the tables of the network and of all datasets
+        in ready_tables"""
+        with self.dataset_lock:
+            datasets = list(self.datasets)
+        return _network_tables + [table for dataset in datasets for table in self.dataset_tables(dataset)]
+
+    def wait_ready(self, tables=None, timeout=None):
+        """Wait until the given tables, or the tables of the network and of
+        all datasets, are built. Return whether they are, which is False
+        right away once their build failed."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.ready_condition:
+            # The datasets added or removed meanwhile count for all tables
+            while not self.ready_tables.issuperset(self.all_tables() if tables is None else tables):
+                if self.build_failed(*(self.all_tables() if tables is None else tables)):
+                    return False
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.ready_condition.wait(remaining)
+            return True
+
+    def set_ready(self, tables):
+        with self.ready_condition:
+            self.ready_tables.update(tables)
+            self.ready_condition.notify_all()
+
+    def build_in_background(self, path, on_ready=None, datasets=None):
+        try:
+            self.update_databases(path, datasets)
+        except Exception as e:
+            logger.exception('Building the database failed')
+            if datasets is None:
+                with self.dataset_lock:
+                    datasets = list(self.datasets)
+            # The datasets of the build not built yet never will be
+            for dataset in datasets:
+                if self.dataset_status(dataset) == 'building':
+                    self.remove_dataset(dataset, 'Building the network failed: %s' % e)
+            # Wakes up the waiters, which no longer wait for the tables
+            # left unbuilt
+            with self.ready_condition:
+                self.build_error = str(e)
+                self.ready_condition.notify_all()
+            return
+        if on_ready is not None:
+            on_ready()
+
+    def update_databases(self, path, datasets=None):
+        """Rebuild the out of date tables of the network and of the given
+        datasets, by default all of them, in the order of
+        _network_build_groups with the datasets built after the Causality
+        table, the default dataset first.
+
+        With build_processes above 1, the resource files are parsed in one
+        process pool for the whole run, so that the files of the later
+        tables are parsed while the earlier ones are written.
+        """
+        if self.build_processes > 1:
+            self.start_pool()
+        try:
+            # MutSig is loaded once its group is built, and the datasets once
+            # the Causality group is
+            self.update_database(path, self.network_file, _table_sources, _network_build_groups,
+                                 before_group={1: self.load_mut_sig_index,
+                                               2: lambda: self.update_datasets(path, datasets)})
+        finally:
+            self.stop_parsing()
+
+    def update_datasets(self, path, datasets=None):
+        """Rebuild the out of date tables of the given datasets, by default
+        all of them, the default dataset first"""
+        if datasets is None:
+            with self.dataset_lock:
+                datasets = list(self.datasets)
+        for dataset in sorted(datasets, key=lambda name: name != self.default_dataset):
+            # A dataset that fails to build is dropped without holding up
+            # the network tables and the other datasets
             try:
-                cur.execute(
-                    "CREATE TABLE Causality(Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Rel TEXT, UriStr TEXT)")
-            except:
-                pass
-
-            for line in causality_file:
-                vals = line.split('\t')
-                id_str1 = vals[0].upper().split('-')
-                id1 = id_str1[0]
-                if len(id_str1) > 1:
-                    p_site1 = id_str1[1]
-                else:
-                    p_site1 = ' '
-
-                id_str2 = vals[2].upper().split('-')
-                id2 = id_str2[0]
-
-                if len(id_str2) > 1:
-                    p_site2 = id_str2[1]
+                self.update_dataset(path, dataset)
+            except Exception as e:
+                logger.exception('Building dataset %s failed' % dataset)
+                self.remove_dataset(dataset, e)
+
+    def update_dataset(self, path, dataset):
+        """Rebuild the tables and correlation store of a dataset if its
+        correlation file or the causality file changed since its last build"""
+        # Held throughout so that the manifest of the dataset is not read
+        # while another build is writing
+        with self.build_lock:
+            with self.dataset_lock:
+                correlation_file = self.datasets.get(dataset)
+            if correlation_file is None:
+                # Removed after its build failed
+                return
+            self.update_database(path, self.dataset_file(dataset), dataset_sources(correlation_file),
+                                 [_dataset_tables], dataset)
+            self.update_correlation_store(path, dataset, correlation_file)
+
+    def update_database(self, path, db_file, table_sources, groups, dataset=None, before_group=None):
+        """Rebuild the tables of groups in db_file whose resource files, as
+        listed by table_sources, changed since the last build.
+
+        The tables are built group by group. Each group is built into a
+        temporary copy of the database, which then replaces it, so the
+        tables of a group can be queried as soon as the group is done and
+        an interrupted build never leaves a database behind that would be
+        trusted on the next start. The tables of a dataset are marked
+        ready as dataset.table. before_group maps the index of a group to a
+        function called before that group is built, whether it is out of
+        date or not. Other processes building db_file are waited for.
+        """
+        # Other processes building the same database meanwhile are waited
+        # for, and the manifest read once they are done
+        with file_lock(db_file):
+            manifest = read_manifest(db_file)
+            old_entries = manifest if manifest is not None else {}
+            tables = [table for group in groups for table in group]
+
+            entries = {}
+            changed = set()
+            for table in tables:
+                for source in table_sources.get(table, []):
+                    if source in entries:
+                        continue
+                    old_entry = old_entries.get(source)
+                    entries[source] = source_entry(os.path.join(path, source), old_entry)
+                    if old_entry is None or entries[source][0] != old_entry[0]:
+                        changed.add(source)
+
+            if manifest is None:
+                stale = list(tables)
+            else:
+                stale = []
+                for table in tables:
+                    if set(table_sources.get(table, [])) & changed or \
+                            set(_table_dependencies.get(table, [])) & set(stale):
+                        stale.append(table)
+
+            def ready_names(tables):
+                return [table if dataset is None else dataset + '.' + table for table in tables]
+
+            self.set_ready(ready_names(table for table in tables if table not in stale))
+            # The manifest written after each group only lists the sources
+            # whose tables are up to date. The sources of the tables of other
+            # groups keep their entries.
+            built_entries = dict(old_entries)
+            for source, entry in entries.items():
+                if source in changed:
+                    built_entries.pop(source, None)
                 else:
-                    p_site2 = ' '
-
-                rel = vals[1]
-
-                uri_arr = []
-                if vals[3]:
-                    uri_arr = vals[3].split(" ")
-
-                if len(uri_arr) == 0:
-                    uri_arr = [vals[3]]
-
-                uri_str = ""
-                for uri in uri_arr:
-                    uri_str = uri_str + "uri= " + uri + "&"
-
-                opp_rel = opposite_rel[rel]
-                cur.execute("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?)", (id1, p_site1, id2, p_site2, rel, uri_str))
-                # opposite relation
-                cur.execute("INSERT INTO Causality VALUES(?, ?, ?, ?, ?, ?)", (id2, p_site2, id1, p_site1, opp_rel, uri_str))
-
-        causality_file.close()
-
-    def populate_correlation_table(self, path):
-        pnnl_path = os.path.join(path, 'PNNL-ovarian-correlations.txt')
-        pnnl_file = open(pnnl_path, 'r')
-
-        with self.cadb:
-            cur = self.cadb.cursor()
-            try:
-                cur.execute(
-                    "CREATE TABLE Correlations(Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Corr REAL, PVal REAL)")
-            except:
-                pass
-
-            for line in pnnl_file:
-                if line.find('/') > -1:  # incorrectly formatted strings
+                    built_entries[source] = entry
+            if not stale:
+                if built_entries != old_entries:
+                    # Only the modification times changed, the contents are the same
+                    cadb = sqlite3.connect(db_file)
+                    write_manifest(cadb, built_entries)
+                    cadb.close()
+            else:
+                logger.info('Rebuilding tables of %s: %s' % (os.path.basename(db_file), ', '.join(stale)))
+                if getattr(self.build_local, 'pool', None) is not None:
+                    # Parse the files of all groups while the first is built
+                    self.start_parsing(path, stale, table_sources)
+
+            copy_database = manifest is not None
+            for ind, group in enumerate(groups):
+                if before_group is not None and ind in before_group:
+                    before_group[ind]()
+                group_tables = [table for table in group if table in stale]
+                if not group_tables:
                     continue
-                vals = line.split('\t')
-                id_str1 = vals[0].upper().split('-')
-                id1 = id_str1[0]
-                if len(id_str1) > 1:
-                    p_site1 = id_str1[1]
-                else:
-                    p_site1 = ' '
-
-                id_str2 = vals[1].upper().split('-')
-                id2 = id_str2[0]
-
-                if len(id_str2) > 1:
-                    p_site2 = id_str2[1]
-                else:
-                    p_site2 = ' '
-
-                corr = float(vals[2].rstrip('\n'))
-
-                p_val = float(vals[3].rstrip('\n'))
-
-                cur.execute("INSERT INTO Correlations VALUES(?, ?, ?, ?, ?, ?)", (id1, p_site1, id2, p_site2, corr, p_val))
+                for table in group_tables:
+                    for source in table_sources.get(table, []):
+                        built_entries[source] = entries[source]
+                self.build_tables(path, db_file, group_tables, table_sources, built_entries,
+                                  copy_database)
+                copy_database = True
+                self.pool.refresh()
+                self.set_ready(ready_names(group_tables))
+
+    def update_correlation_store(self, path, dataset, correlation_file):
+        """Open the correlation store of a dataset, rebuilding it first if
+        the correlation or causality files changed since it was built"""
+        if not self.use_correlation_store:
+            return
+        if correlation_store.np is None:
+            logger.warning('numpy is not installed, correlations are looked up in SQLite')
+            return
+
+        store_dir = os.path.join(path, dataset + '-correlations')
+        # Other processes building the store meanwhile are waited for
+        with file_lock(store_dir):
+            db_file = self.dataset_file(dataset)
+            manifest = read_manifest(db_file)
+            sources = dict((source, manifest[source][0])
+                           for source in dataset_sources(correlation_file)['Correlations'])
+            if correlation_store.read_sources(store_dir) != sources:
+                start = time.time()
+                cadb = sqlite3.connect(db_file)
+                try:
+                    correlation_store.build_store(store_dir, cadb.execute(
+                        "SELECT Id1, PSite1, Id2, PSite2, Corr, PVal, Explained FROM Correlations ORDER BY rowid"),
+                        sources)
+                finally:
+                    cadb.close()
+                self.build_times[dataset + '.Correlation_Store'] = time.time() - start
+                logger.info('Built correlation store of %s in %.2f s' %
+                            (dataset, self.build_times[dataset + '.Correlation_Store']))
+            self.correlation_stores[dataset] = correlation_store.CorrelationStore(store_dir)
+
+    def build_tables(self, path, db_file, tables, table_sources, entries, copy_database):
+        """Build tables into a temporary copy of a database and replace the
+        database with it"""
+        # A file of its own, in the same directory so that it can be
+        # renamed over the database
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(db_file) + '.',
+                                        suffix='.tmp', dir=os.path.dirname(db_file))
+        os.close(fd)
+        os.chmod(tmp_file, 0o644)
+        with self.build_lock:
+            try:
+                if copy_database:
+                    shutil.copyfile(db_file, tmp_file)
+                self.build_db = sqlite3.connect(tmp_file)
+                try:
+                    self.populate_tables(path, tables, table_sources)
+                    write_manifest(self.build_db, entries)
+                finally:
+                    self.build_db.close()
+                    self.build_db = None
+                _replace(tmp_file, db_file)
+            except BaseException:
+                os.remove(tmp_file)
+                raise
+
+    def populate_tables(self, path, tables, table_sources):
+        build_steps = {
+            'Correlations': (self.populate_correlation_table, (path, table_sources)),
+            'Causality': (self.populate_causality_table, (path,)),
+            'MutSig': (self.populate_mutsig_table, (path,)),
+            'Unexplained_Correlations': (self.populate_unexplained_table, ()),
+            'Explained_Correlations': (self.populate_explained_table, ()),
+            'Ranked_Correlations': (self.populate_ranked_table, ()),
+            'Sif_Relations': (self.populate_sif_relations_table, (path,)),
+            'Mutex_Groups': (self.populate_mutex_groups_table, (path,)),
+            'Mutex_Members': (self.populate_mutex_members_table, ()),
+        }
 
-        pnnl_file.close()
+        # Builds outside of update_databases parse in a pool of their own
+        own_pool = self.build_processes > 1 and getattr(self.build_local, 'pool', None) is None
+        if own_pool:
+            self.start_pool()
+            self.start_parsing(path, tables, table_sources)
+        self.set_pragmas(_build_pragmas)
+        try:
+            for table in tables:
+                populate, args = build_steps[table]
+                start = time.time()
+                populate(*args)
+                self.create_indexes(table)
+                self.build_times[table] = time.time() - start
+                logger.info('Built table %s in %.2f s' % (table, self.build_times[table]))
+            with self.build_db:
+                self.build_db.execute("ANALYZE")
+        finally:
+            self.set_pragmas(_default_pragmas)
+            if own_pool:
+                self.stop_parsing()
+
+    def start_pool(self):
+        """Open the pool the builds of the calling thread parse the
+        resource files in"""
+        self.build_local.pool = multiprocessing.Pool(self.build_processes)
+        self.build_local.parse_jobs = {}
+
+    def start_parsing(self, path, tables, table_sources):
+        """Start parsing the resource files of tables in the pool of the
+        calling thread.
+
+        Every file is split into chunks of about _build_chunk_size bytes.
+        The first chunks of all files are queued at once, so that
+        independent files are parsed concurrently while the tables are
+        written one after the other. Up to two chunks per process are
+        parsed ahead of the table being written from each file.
+        """
+        for table in tables:
+            if table not in _table_parsers:
+                continue
+            source = table_sources[table][0]
+            self.build_local.parse_jobs[(source, _table_parsers[table])] = _ParsedChunks(
+                self.build_local.pool, _table_parsers[table], os.path.join(path, source),
+                2 * self.build_processes)
+
+    def stop_parsing(self):
+        """Close the pool of the calling thread, dropping the chunks still
+        being parsed"""
+        pool = getattr(self.build_local, 'pool', None)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        self.build_local.pool = None
+        self.build_local.parse_jobs = {}
+
+    def read_rows(self, path, source, parse_rows):
+        """Generate the rows parsed by parse_rows from a resource file, in
+        file order, from the process pool if the file is being parsed there"""
+        jobs = getattr(self.build_local, 'parse_jobs', {}).pop((source, parse_rows), None)
+        if jobs is None:
+            with open(os.path.join(path, source), 'r') as fp:
+                for row in parse_rows(fp):
+                    yield row
+            return
+        for row in jobs:
+            yield row
+
+    def set_pragmas(self, pragmas):
+        for pragma in pragmas:
+            self.build_db.execute(pragma)
+
+    def create_indexes(self, table):
+        """Create the indexes covering the lookups of the find_* methods"""
+        with self.build_db:
+            cur = self.build_db.cursor()
+            for index_name, columns in _table_indexes.get(table, []):
+                cur.execute("CREATE INDEX IF NOT EXISTS %s ON %s(%s)" % (index_name, table, columns))
+
+    # Each causal relationship is stored once in Causality_Relations, with
+    # the JSON list of the ids of its provenance URIs, interned in
+    # Provenance_Uris. The Causality view adds the opposite relationship
+    # of each right after it in Seq order.
+    def populate_causality_table(self, path):
+        uri_ids = {}
+
+        def rows():
+            for row in self.read_rows(path, 'causative-data-centric.sif', _causality_rows):
+                ids = [uri_ids.setdefault(uri, len(uri_ids) + 1) for uri in json.loads(row[5])]
+                yield row[:5] + (json.dumps(ids),) + row[6:]
+
+        with self.build_db:
+            cur = self.build_db.cursor()
+            cur.execute("DROP VIEW IF EXISTS Causality")
+            cur.execute("DROP TABLE IF EXISTS Causality_Relations")
+            cur.execute("DROP TABLE IF EXISTS Provenance_Uris")
+            cur.execute("CREATE TABLE Causality_Relations(Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Rel TEXT, "
+                        "UriIds TEXT, Res1 TEXT, Pos1 TEXT, Res2 TEXT, Pos2 TEXT, IndraJson TEXT)")
+            cur.executemany("INSERT INTO Causality_Relations VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows())
+            cur.execute("CREATE TABLE Provenance_Uris(UriId INTEGER PRIMARY KEY, Uri TEXT)")
+            cur.executemany("INSERT INTO Provenance_Uris VALUES(?, ?)",
+                            ((uri_id, uri) for uri, uri_id in uri_ids.items()))
+            cur.execute("CREATE VIEW Causality AS "
+                        "SELECT " + _relation_columns + " FROM Causality_Relations UNION ALL "
+                        "SELECT " + _opposite_columns + " FROM Causality_Relations")
+        self.create_indexes('Causality_Relations')
+
+    # The correlations are loaded with an Explained flag telling whether a
+    # causal relationship between the same sites explains them, looked up in
+    # a hash set of the keys of the Causality table of the network database
+    # as the rows stream in
+    def populate_correlation_table(self, path, table_sources):
+        cadb = connect_read_only(self.network_file)
+        try:
+            explained_keys = set(cadb.execute("SELECT Id1, PSite1, Id2, PSite2 FROM Causality"))
+        finally:
+            cadb.close()
+        rows = (row + (row[:4] in explained_keys,)
+                for row in self.read_rows(path, table_sources['Correlations'][0], _correlation_rows))
+
+        with self.build_db:
+            cur = self.build_db.cursor()
+            cur.execute("DROP TABLE IF EXISTS Correlations")
+            cur.execute("CREATE TABLE Correlations(Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Corr REAL, PVal REAL, "
+                        "Explained INTEGER)")
+            cur.executemany("INSERT INTO Correlations VALUES(?, ?, ?, ?, ?, ?, ?)", rows)
 
     def populate_mutsig_table(self, path):
-        mutsig_path = os.path.join(path, 'scores-mutsig.txt')
-        mutsig_file = open(mutsig_path, 'r')
-
-        with self.cadb:
-            cur = self.cadb.cursor()
+        with self.build_db:
+            cur = self.build_db.cursor()
             cur.execute("DROP TABLE IF EXISTS MutSig")
-            try:
-                cur.execute("CREATE TABLE MutSig(Id TEXT,  PVal REAL)")
-            except:
-                pass
-
-            for line in mutsig_file:
-                vals = line.split('\t')
-                gene_id = vals[1]
-                p_val = vals[17]
-                cur.execute("INSERT INTO MutSig VALUES(?, ?)", (gene_id,  p_val))
-
-        mutsig_file.close()
+            cur.execute("CREATE TABLE MutSig(Id TEXT,  PVal REAL, Level TEXT)")
+            cur.executemany("INSERT INTO MutSig VALUES(?, ?, ?)",
+                            self.read_rows(path, 'scores-mutsig.txt', _mutsig_rows))
 
-
-
-    # Find the correlations with a causal explanation
+    # The correlations with a causal explanation. The view only filters on
+    # the Explained flag set when the correlations are loaded, no causal
+    # relationship is joined in.
     def populate_explained_table(self):
-        with self.cadb:
-            cur = self.cadb.cursor()
-            cur.execute("DROP TABLE IF EXISTS Explained_Correlations")
-            cur.execute("CREATE TABLE Explained_Correlations AS SELECT * FROM Correlations "
-                        "LEFT JOIN Causality ON Causality.Id1 = Correlations.Id1 AND Causality.Id2 = Correlations.Id2  "
-                        "AND Causality.PSite1 = Correlations.PSite1 AND Causality.PSite2 = Correlations.PSite2 "
-                        "WHERE Rel IS NOT NULL",
-                        ).fetchall()
-
-    # Find the correlations without a causal explanation
+        with self.build_db:
+            cur = self.build_db.cursor()
+            cur.execute("DROP VIEW IF EXISTS Explained_Correlations")
+            cur.execute("CREATE VIEW Explained_Correlations AS SELECT * FROM Correlations "
+                        "WHERE Explained")
+
+    # The correlations without a causal explanation
     def populate_unexplained_table(self):
-        with self.cadb:
-            cur = self.cadb.cursor()
-            cur.execute("DROP TABLE IF EXISTS Unexplained_Correlations")
-            cur.execute("CREATE TABLE Unexplained_Correlations AS SELECT * FROM Correlations "
-                        "LEFT JOIN Causality ON Causality.Id1 = Correlations.Id1 AND Causality.Id2 = Correlations.Id2  "
-                        "AND Causality.PSite1 = Correlations.PSite1 AND Causality.PSite2 = Correlations.PSite2 "
-                        "WHERE Rel IS NULL",
-                        ).fetchall()
+        with self.build_db:
+            cur = self.build_db.cursor()
+            cur.execute("DROP VIEW IF EXISTS Unexplained_Correlations")
+            cur.execute("CREATE VIEW Unexplained_Correlations AS SELECT * FROM Correlations "
+                        "WHERE NOT Explained")
+
+    # Each correlation once per gene it involves, with its absolute value
+    # stored so that the walk down the correlations of a gene can be read
+    # off the (Gene, Explained, AbsCorr) index in order
+    def populate_ranked_table(self):
+        columns = "c.Id1, c.PSite1, c.Id2, c.PSite2, c.Corr, c.PVal"
+        with self.build_db:
+            cur = self.build_db.cursor()
+            cur.execute("DROP TABLE IF EXISTS Ranked_Correlations")
+            cur.execute("CREATE TABLE Ranked_Correlations(Gene TEXT, Explained INTEGER, AbsCorr REAL, "
+                        "Id1 TEXT, PSite1 TEXT, Id2 TEXT, PSite2 TEXT, Corr REAL, PVal REAL)")
+            cur.execute("INSERT INTO Ranked_Correlations "
+                        "SELECT c.Id1, c.Explained, ABS(c.Corr), " + columns + " FROM Correlations c")
+            cur.execute("INSERT INTO Ranked_Correlations "
+                        "SELECT c.Id2, c.Explained, ABS(c.Corr), " + columns + " FROM Correlations c "
+                        "WHERE c.Id2 != c.Id1")
 
     #All sif relations from PathwayCommons
     def populate_sif_relations_table(self, path):
-        pc_path = os.path.join(path, 'PC.sif')
-        pc_file = open(pc_path, 'r')
-
-        with self.cadb:
-            cur = self.cadb.cursor()
+        with self.build_db:
+            cur = self.build_db.cursor()
             cur.execute("DROP TABLE IF EXISTS Sif_Relations")
             cur.execute("CREATE TABLE Sif_Relations(Id1 TEXT,  Id2 TEXT, Rel TEXT)")
-            for line in pc_file:
-                vals = line.split('\t')
-                id1 = vals[0].upper()
-                id2 = (vals[2].rstrip('\n')).upper()
-                rel = vals[1]
-                cur.execute("INSERT INTO Sif_Relations VALUES(?, ?, ?)", (id1, id2, rel))
-
-        pc_file.close()
-
-    def populate_mutex_table(self, path):
-        mutex_path = os.path.join(path, 'ranked-groups.txt')
-        mutex_file = open(mutex_path, 'r')
-
-        with self.cadb:
-            cur = self.cadb.cursor()
-            cur.execute("DROP TABLE IF EXISTS Mutex")
-            try:
-                cur.execute("CREATE TABLE Mutex(Id1 TEXT, Id2 TEXT, Id3 TEXT, Score REAL)")
-            except:
-                pass
-
-            for line in mutex_file:
-                vals = line.split('\t')
-                vals[len(vals) - 1] = vals[len(vals) - 1].rstrip('\n')
-                score = vals[0]
-                gene1 = vals[2]
-                gene2 = vals[3]
-                if len(vals) > 4:
-                    gene3 = vals[4]
-                else:
-                    gene3 = None
-
-                cur.execute("INSERT INTO Mutex VALUES(?, ?, ?, ?)", (gene1, gene2, gene3, score))
-
-        mutex_file.close()
+            cur.executemany("INSERT INTO Sif_Relations VALUES(?, ?, ?)", self.read_rows(path, 'PC.sif', _sif_rows))
+
+    # Mutually exclusive groups of any size, with their genes as a JSON
+    # list. The group ids follow the scores, best first, so that the groups
+    # of a gene are read off the Mutex_Members index in rank order.
+    def populate_mutex_groups_table(self, path):
+        # Python sorts are stable, so groups of equal score stay in file order
+        groups = sorted(self.read_rows(path, 'ranked-groups.txt', _mutex_rows), key=lambda group: group[0])
+
+        with self.build_db:
+            cur = self.build_db.cursor()
+            cur.execute("DROP TABLE IF EXISTS Mutex_Groups")
+            cur.execute("CREATE TABLE Mutex_Groups(GroupId INTEGER PRIMARY KEY, Score REAL, Genes TEXT)")
+            cur.executemany("INSERT INTO Mutex_Groups(Score, Genes) VALUES(?, ?)", groups)
+
+    # The groups each gene is a member of
+    def populate_mutex_members_table(self):
+        with self.build_db:
+            cur = self.build_db.cursor()
+            cur.execute("DROP TABLE IF EXISTS Mutex_Members")
+            cur.execute("CREATE TABLE Mutex_Members(Gene TEXT, GroupId INTEGER)")
+            cur.execute("INSERT INTO Mutex_Members SELECT DISTINCT json_each.value, GroupId "
+                        "FROM Mutex_Groups, json_each(Mutex_Groups.Genes)")
 
     # Convert the row from sql table into causality object
-    # Positions need to be trimmed to correct PC formatting. E.g. s100S for pSite
+    # The residues and positions of the sites are parsed from the PC
+    # formatted sites (e.g. S100S) when the table is built
     @staticmethod
     def row_to_causality(row):
-        sites1 = re.findall('([TYS][0-9]+)[TYS]', row[1])
-        sites2 = re.findall('([TYS][0-9]+)[TYS]', row[3])
-        res1 = [site[0] for site in sites1]
-        res2 = [site[0] for site in sites2]
-        pos1 = [site[1:] for site in sites1]
-        pos2 = [site[1:] for site in sites2]
         mods1 = [{'mod_type': 'phosphorylation',
-                  'residue': site[0],
-                  'position': site[1:],
+                  'residue': res,
+                  'position': pos,
                   'is_modified': True}
-                  for site in sites1]
+                 for res, pos in zip(row[6].split(','), row[7].split(',')) if res]
         mods2 = [{'mod_type': 'phosphorylation',
-                  'residue': site[0],
-                  'position': site[1:],
+                  'residue': res,
+                  'position': pos,
                   'is_modified': True}
-                  for site in sites2]
+                 for res, pos in zip(row[8].split(','), row[9].split(',')) if res]
         causality = {'id1': row[0], 'mods1': mods1,
                      'id2': row[2], 'mods2': mods2,
                      'rel': row[4],
-                     'uri_str': row[5]
+                     'uri_ids': json.loads(row[5])
                      }
         return causality
 
@@ -259,202 +1366,416 @@ class CausalityAgent:
                 'explainable': "\"unassigned\""}
         return corr
 
-    # Find the causal relationship between gene1 and gene2
-    def find_causality(self, param):
-        with self.cadb:
-            cur = self.cadb.cursor()
-            sources = param.get('source').get('id')
-            targets = param.get('target').get('id')
-
-            if isinstance(sources, list):
-                source_str = "(" + ", ".join((("'" + str(source) + "'") for source in sources)) + ")"
-            else:
-                source_str = "('" + sources + "')"
-
-            if isinstance(targets, list):
-                target_str = "(" + ", ".join((("'" + str(target) + "'") for target in targets)) + ")"
-            else:
-                target_str = "('" + targets + "')"
-
-            query = "SELECT * FROM Causality WHERE Id1 IN " + source_str + "AND Id2 IN  " + target_str
+    def select(self, query, args=()):
+        """Run a read query and return its rows.
 
-            rows = cur.execute(query).fetchall()
+        List arguments are bound as one JSON array, to be expanded in the
+        query with an IN _json_list clause. The text of a query is then the
+        same for any number of genes, so its prepared statement is taken
+        from the statement cache instead of being parsed and planned again.
+        """
+        args = tuple(json.dumps(arg) if isinstance(arg, list) else arg for arg in args)
+        start = time.time()
+        with self.cadb:
+            rows = self.cadb.execute(query, args).fetchall()
+        causality_metrics.metrics.sql(query, time.time() - start, len(rows))
+        return rows
+
+    def select_chunks(self, query, args=(), chunk_size=500):
+        """Like select, but generate the rows in lists of at most chunk_size"""
+        args = tuple(json.dumps(arg) if isinstance(arg, list) else arg for arg in args)
+        cur = self.cadb.cursor()
+        # Only the time spent in SQLite is recorded, not the time spent by
+        # the caller between chunks
+        seconds = 0
+        row_count = 0
+        try:
+            start = time.time()
+            cur.execute(query, args)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                seconds += time.time() - start
+                if not rows:
+                    break
+                row_count += len(rows)
+                yield rows
+                start = time.time()
+        finally:
+            cur.close()
+            causality_metrics.metrics.sql(query, seconds, row_count)
 
-            if len(rows) > 0:
-                row = rows[0]
-                causality = self.row_to_causality(row)
-                return causality
-            else:
-                return ''
+    # Find the causal relationship between gene1 and gene2
+    def find_causality(self, param):
+        row = self.find_causality_row(param)
+        if row is not None:
+            causality = self.row_to_causality(row)
+            return causality
+        else:
+            return ''
+
+    def find_causality_indra(self, param):
+        """Like find_causality, but return the (INDRA JSON, URI ids) pair
+        of the relationship like find_causality_targets_indra, or None if
+        there is none or it has no INDRA statement"""
+        row = self.find_causality_row(param)
+        if row is None:
+            return None
+        if row[10] is None:
+            _log_without_indra(1, 1)
+            return None
+        return row[10], row[5]
+
+    def find_causality_row(self, param):
+        """Return the Causality row of the first relationship from
+        param.source to param.target, or None if there is none"""
+        sources = _as_list(param.get('source').get('id'))
+        targets = _as_list(param.get('target').get('id'))
+
+        query, args = _causality_query("*", (("Id1 IN " + _json_list + " AND Id2 IN " + _json_list,
+                                              (sources, targets)),
+                                             ("Id2 IN " + _json_list + " AND Id1 IN " + _json_list,
+                                              (sources, targets))))
+        rows = self.select(query + " ORDER BY Seq LIMIT 1", args)
+        return rows[0] if rows else None
+
+    # Find chains of causal relationships from gene1 to gene2
+    def find_causal_paths(self, param, max_hops=3, max_paths=10, time_budget=1.0):
+        """Return up to max_paths causal paths of at most max_hops relations
+        from param.source to param.target, shortest first. Each path is a
+        list of causality objects. The search returns the paths found so far
+        once time_budget seconds have passed."""
+        paths = self.find_causal_path_rows(param, max_hops, max_paths, time_budget)
+        return [[self.row_to_causality(row) for row in path] for path in paths]
+
+    def find_causal_paths_indra(self, param, max_hops=3, max_paths=10, time_budget=1.0):
+        """Like find_causal_paths, but each relation of a path is the
+        (INDRA JSON, URI ids) pair of find_causality_targets_indra. The
+        paths with a relation that has no INDRA statement are left out."""
+        paths = self.find_causal_path_rows(param, max_hops, max_paths, time_budget)
+        statements = [[(row[10], row[5]) for row in path] for path in paths
+                      if all(row[10] is not None for row in path)]
+        if len(statements) < len(paths):
+            logger.info('Left out %d of %d causal paths without an INDRA statement' %
+                        (len(paths) - len(statements), len(paths)))
+        return statements
+
+    def find_causal_path_rows(self, param, max_hops=3, max_paths=10, time_budget=1.0):
+        """Return the paths of find_causal_paths as lists of Causality rows"""
+        sources = _as_list(param.get('source').get('id'))
+        targets = _as_list(param.get('target').get('id'))
+
+        graph = causality_graph.get_causality_graph(self.network_file)
+        with causality_metrics.metrics.span('graph'):
+            return graph.find_paths(sources, targets, max_hops, max_paths, time_budget)
 
     # Find the causal relationship from param.source to target
     def find_causality_targets(self, param):
-        with self.cadb:
-            cur = self.cadb.cursor()
-            genes = param.get('id')
-
-            if isinstance(genes, list):
-                id_str =  ", ".join((("'" + str(gene) + "'") for gene in genes))
+        return [causality for chunk in self.iter_causality_targets(param) for causality in chunk]
+
+    def iter_causality_targets(self, param, chunk_size=500):
+        """Generate the results of find_causality_targets in lists of at most
+        chunk_size, without holding all rows of a hub gene in memory"""
+        query, args = _ordered_targets_query(param)
+        for rows in self.select_chunks(query, args, chunk_size):
+            yield [self.row_to_causality(row) for row in rows]
+
+    def find_causality_targets_page(self, param):
+        """Return one page of the results of find_causality_targets.
+
+        param takes the optional pageSize and the pageToken of the previous
+        page. The page is returned as a dict with the targets, the total
+        number of results and the nextPageToken to pass for the next page,
+        which is None on the last page. Raises ValueError if the page size
+        or token are not valid.
+        """
+        rows, total, next_page_token, _ = self.select_page(param)
+        return {'targets': [self.row_to_causality(row) for row in rows],
+                'total': total,
+                'nextPageToken': next_page_token}
+
+    def find_causality_targets_indra_page(self, param):
+        """Like find_causality_targets_page, but the targets are the
+        (INDRA JSON, URI ids) pairs of find_causality_targets_indra"""
+        rows, total, next_page_token, matched = self.select_page(param, "IndraJson IS NOT NULL")
+        _log_without_indra(matched - total, matched)
+        return {'targets': [(row[10], row[5]) for row in rows],
+                'total': total,
+                'nextPageToken': next_page_token}
+
+    def select_page(self, param, condition=None):
+        """Return the Causality rows of a page of the causal relationships
+        of param that match condition, the total number of them, the token
+        of the next page and the number of relationships whether or not
+        they match condition"""
+        page_size, after = _page_params(param)
+
+        # The total is counted again for each page, through the indexes but
+        # reading the rows of all relationships of param if there is a
+        # condition
+        query, args = _causality_query("COUNT(*), SUM(%s)" % (condition or 1), _targets_filter(param))
+        matched, total = self.select(query, args)[0]
+        total = total or 0
+        # Pages are keyed by the Seq of their last row, which bounds the
+        # rowids searched in each arm, so that for one gene and relation a
+        # page reads only its own rows, as described in
+        # _ordered_targets_query
+        query, args = _ordered_targets_query(param, after, condition)
+        rows = self.select(query + " LIMIT ?", args + (page_size + 1,))
+        next_page_token = str(rows[page_size - 1][11]) if len(rows) > page_size else None
+        return rows[:page_size], total, next_page_token, matched
+
+    def get_correlation_cursor(self, gene, session_id=None, dataset=None):
+        """Return the correlation cursor of gene in the given session and
+        dataset"""
+        key = (session_id, self.get_dataset(dataset), gene)
+        with self.cursor_lock:
+            cursor = self.cursors.pop(key, None)
+            if cursor is None:
+                cursor = CorrelationCursor()
+            # Re-insert to mark as most recently used
+            self.cursors[key] = cursor
+            while len(self.cursors) > self.max_cursors:
+                self.cursors.popitem(last=False)
+            return cursor
+
+    def next_ranked_correlation(self, gene, explained, session_id=None, dataset=None):
+        """Return the next correlation row of gene in the explained or
+        unexplained walk of the session through a dataset, or None at the
+        end of the walk"""
+        dataset = self.get_dataset(dataset)
+        cursor = self.get_correlation_cursor(gene, session_id, dataset)
+        store = self.correlation_stores.get(dataset)
+        with cursor.lock:
+            position = cursor.positions[explained]
+            if store is not None:
+                row, cursor.positions[explained] = store.next_ranked(gene, explained, position)
+                return row
+            if position is None:
+                rows = self.select(_next_ranked_query(dataset, False), (gene, explained))
             else:
-                id_str = "('" + genes + "')"
-
-            rel = param.get('rel')
-
-            if rel.upper() == "MODULATES":
-                query = "SELECT * FROM Causality WHERE Id1 IN " + "(" + id_str + ")";
-                rows = cur.execute(query).fetchall()
+                rows = self.select(_next_ranked_query(dataset, True),
+                                   (gene, explained, position[0], position[0], position[1]))
+            if not rows:
+                return None
+            row = rows[0]
+            cursor.positions[explained] = row[6:]
+            return row[:6]
+
+    def reset_cursors(self, session_id=None):
+        """Restart the correlation walks of a session, or of every session if
+        session_id is None"""
+        with self.cursor_lock:
+            if session_id is None:
+                self.cursors.clear()
             else:
-                query = "SELECT * FROM Causality WHERE Rel = ?  AND Id1 IN " + "(" + id_str + ")";
-                rows = cur.execute(query, (rel,)).fetchall()
-
-            targets = []
-            for row in rows:
-                causality = self.row_to_causality(row)
-                targets.append(causality)
-
-            return targets
+                for key in [key for key in self.cursors if key[0] == session_id]:
+                    del self.cursors[key]
+
+    def find_causality_targets_many(self, genes, rel):
+        """Find the causal relationships of type rel from each of genes with a
+        single query, returned as lists keyed by gene"""
+        targets = dict((gene, []) for gene in genes)
+        for causality in self.find_causality_targets({'id': list(genes), 'rel': rel}):
+            targets[causality['id1']].append(causality)
+        return targets
+
+    def find_causality_targets_indra(self, param):
+        """Like find_causality_targets, but return the INDRA statement JSON
+        stored with each relationship, along with the JSON list of the ids
+        of its provenance URIs"""
+        query, args = _causality_query("IndraJson, UriIds", _targets_filter(param))
+        rows = self.select(query + " ORDER BY Seq", args)
+        statements = [row for row in rows if row[0] is not None]
+        _log_without_indra(len(rows) - len(statements), len(rows))
+        return statements
+
+    def find_causality_targets_many_indra(self, genes, rel):
+        """Like find_causality_targets_many, but return the INDRA statement
+        JSON of the relationships like find_causality_targets_indra, in
+        lists keyed by gene"""
+        targets = dict((gene, []) for gene in genes)
+        query, args = _causality_query("Id1, IndraJson", _targets_filter({'id': list(genes), 'rel': rel}))
+        rows = self.select(query + " ORDER BY Seq", args)
+        left_out = 0
+        for gene, indra_json in rows:
+            if indra_json is None:
+                left_out += 1
+            else:
+                targets[gene].append(indra_json)
+        _log_without_indra(left_out, len(rows))
+        return targets
+
+    def find_provenance_uris(self, uri_ids):
+        """Return the provenance URIs with the given ids, each once, in the
+        order of their first id"""
+        unique_ids = []
+        seen = set()
+        for uri_id in uri_ids:
+            if uri_id not in seen:
+                seen.add(uri_id)
+                unique_ids.append(uri_id)
+        uris = self.provenance_uris(unique_ids)
+        return [uris[uri_id] for uri_id in unique_ids if uri_id in uris]
+
+    def provenance_uris(self, uri_ids):
+        """Return the provenance URIs with the given ids keyed by id"""
+        rows = self.select("SELECT UriId, Uri FROM Provenance_Uris WHERE UriId IN " + _json_list,
+                           (list(uri_ids),))
+        return dict((uri_id, _expand_uri(uri)) for uri_id, uri in rows)
+
+    def add_provenance(self, causalities):
+        """Set the uri_str of each of causalities to its provenance URIs,
+        each as "uri= <uri>&", for the SBGNViz clients that cannot look them
+        up by id. Returns causalities."""
+        uris = self.provenance_uris(set(uri_id for causality in causalities
+                                        for uri_id in causality['uri_ids']))
+        for causality in causalities:
+            causality['uri_str'] = ''.join('uri= ' + uris[uri_id] + '&'
+                                           for uri_id in causality['uri_ids'] if uri_id in uris)
+        return causalities
 
     # This returns the next interesting relationship be it explained or unexplained
-    def find_next_correlation(self, gene):
-
-        with self.cadb:
-            cur = self.cadb.cursor()
-
-            causal_rows = cur.execute("SELECT * FROM Explained_Correlations WHERE Id1 = ? OR Id2 = ? "
-                                      "ORDER BY ABS(Corr) DESC",
-                                      (gene, gene)).fetchall()
-
-            row_cnt = len(causal_rows)
-            if row_cnt > self.causality_ind:
-                row = causal_rows[self.causality_ind]
-                self.causality_ind = self.causality_ind + 1
-
-                corr = self.get_correlation_between(row[0], row[1], row[2], row[3])
-                corr['explainable'] = "\"explainable\""
-            else:
-                corr = self.find_next_unexplained_correlation(gene)
+    def find_next_correlation(self, gene, session_id=None, dataset=None):
+        row = self.next_ranked_correlation(gene, True, session_id, dataset)
+        if row is not None:
+            corr = self.row_to_correlation(row)
+            corr['explainable'] = "\"explainable\""
+        else:
+            corr = self.find_next_unexplained_correlation(gene, session_id, dataset)
 
-            # revert correlation info
-            if corr != '' and corr['id2'] == gene:
-                tmp = corr['id1']
-                corr['id1'] = corr['id2']
-                corr['id2'] = tmp
-                tmp = corr['pSite1']
-                corr['pSite1'] = corr['pSite2']
-                corr['pSite2'] = tmp
+        # revert correlation info
+        if corr != '' and corr['id2'] == gene:
+            tmp = corr['id1']
+            corr['id1'] = corr['id2']
+            corr['id2'] = tmp
+            tmp = corr['pSite1']
+            corr['pSite1'] = corr['pSite2']
+            corr['pSite2'] = tmp
 
-            return corr
+        return corr
 
     # We are sure that there is a correlation between these
-    def get_correlation_between(self, gene1, p_site1, gene2, p_site2):
-        with self.cadb:
-            cur = self.cadb.cursor()
-            # Don't change the order
-            rows = cur.execute("SELECT * FROM Correlations WHERE Id1 = ? AND PSite1 = ?  AND Id2 = ?  AND PSite2 = ? "
-                               "OR Id1 = ? AND PSite1 = ?  AND Id2 = ?  AND PSite2 = ? ",
-                               (gene1, p_site1, gene2, p_site2, gene2, p_site2, gene1, p_site1)).fetchall()
+    def get_correlation_between(self, gene1, p_site1, gene2, p_site2, dataset=None):
+        dataset = self.get_dataset(dataset)
+        store = self.correlation_stores.get(dataset)
+        if store is not None:
+            row = store.get_correlation_between(gene1, p_site1, gene2, p_site2)
+            return self.row_to_correlation(row) if row is not None else ''
+
+        # Don't change the order
+        rows = self.select("SELECT * FROM %s.Correlations WHERE Id1 = ? AND PSite1 = ?  AND Id2 = ?  AND PSite2 = ? "
+                           "OR Id1 = ? AND PSite1 = ?  AND Id2 = ?  AND PSite2 = ? " % _schema(dataset),
+                           (gene1, p_site1, gene2, p_site2, gene2, p_site2, gene1, p_site1))
+
+        corr = ''
+        if len(rows) > 0:
+            row = rows[0]
+            corr = self.row_to_correlation(row)
 
-            corr = ''
-            if len(rows) > 0:
-                row = rows[0]
-                corr = self.row_to_correlation(row)
-
-            return corr
+        return corr
 
     # Find the next highest unexplained correlation
-    def find_next_unexplained_correlation(self, gene):
-        with self.cadb:
-            cur = self.cadb.cursor()
-            rows = cur.execute("SELECT * FROM Unexplained_Correlations "
-                               "WHERE Id1 = ? OR Id2 = ? ORDER BY ABS(Corr) DESC",
-                               (gene, gene)).fetchall()
-
-            row_cnt = len(rows)
-            if row_cnt > self.corr_ind:
-                row = rows[self.corr_ind]
-                self.corr_ind = self.corr_ind + 1
-                corr = self.row_to_correlation(row)
-                corr['explainable'] = "\"unexplainable\""
-                return corr
-            else:
-                return ''
+    def find_next_unexplained_correlation(self, gene, session_id=None, dataset=None):
+        row = self.next_ranked_correlation(gene, False, session_id, dataset)
+        if row is not None:
+            corr = self.row_to_correlation(row)
+            corr['explainable'] = "\"unexplainable\""
+            return corr
+        else:
+            return ''
+
+    def load_mut_sig_index(self):
+        """Load the significance levels of the MutSig table into memory"""
+        start = time.time()
+        self.mut_sig_index = causality_graph.load_mut_sig_index(self.network_file)
+        logger.info('Loaded MutSig levels of %d genes in %.2f s' %
+                    (len(self.mut_sig_index.gene_names), time.time() - start))
+        return self.mut_sig_index
+
+    def get_mut_sig_index(self):
+        index = self.mut_sig_index
+        if index is None:
+            # Queried between the MutSig table being marked ready and its
+            # levels being loaded
+            index = self.load_mut_sig_index()
+        return index
 
     def find_mut_sig(self, gene):
-        with self.cadb:
-            cur = self.cadb.cursor()
-            p_val = cur.execute("SELECT PVal FROM MutSig WHERE Id = ?", (gene,)).fetchone()
+        """Find the mutation significance of gene, "unknown" if it is not
+        in MutSig"""
+        return self.get_mut_sig_index().levels.get(gene, _mut_sig_unknown)
 
-            if p_val[0] < 0.01:
-                return "highly significant"
-            elif p_val[0] < 0.05:
-                return "significant"
-            else:
-                return "not significant"
+    def find_mut_sig_many(self, genes):
+        """Find the mutation significance of each of genes, keyed by gene.
+        Genes missing from MutSig are "unknown"."""
+        levels = self.get_mut_sig_index().levels
+        return dict((gene, levels.get(gene, _mut_sig_unknown)) for gene in genes)
 
     # Find common upstreams between gene1 and gene2
     def find_common_upstreams(self, genes):
-        with self.cadb:
-            cur = self.cadb.cursor()
-
-            if len(genes) < 2:
-                return ''
-
-            gene1 = genes[0]
-            gene2 = genes[1]
-
-            upstreams = cur.execute("SELECT s1.Id1 FROM Sif_Relations s1 "
-                                    "INNER JOIN Sif_Relations s2 ON (s2.Id1 = s1.Id1 AND s1.Id2 = ? AND s2.id2 = ? AND  "
-                                    "s1.Rel = 'controls-state-change-of' AND s2.Rel = s1.Rel)",
-                                    (gene1, gene2)).fetchall()
-
-
-            for i in range(2, len(genes)):
-                gene = genes[i]
+        if len(genes) < 2:
+            return ''
+
+        if self.use_sif_graph:
+            graph = causality_graph.get_sif_graph(self.network_file)
+            with causality_metrics.metrics.span('graph'):
+                return [{'name': gene} for gene in graph.find_common_upstreams(genes)]
+
+        gene1 = genes[0]
+        gene2 = genes[1]
+
+        upstreams = self.select("SELECT s1.Id1 FROM Sif_Relations s1 "
+                                "INNER JOIN Sif_Relations s2 ON (s2.Id1 = s1.Id1 AND s1.Id2 = ? AND s2.id2 = ? AND  "
+                                "s1.Rel = 'controls-state-change-of' AND s2.Rel = s1.Rel)",
+                                (gene1, gene2))
+
+
+        for i in range(2, len(genes)):
+            gene = genes[i]
+
+
+            upstream_arr = []
+            for upstream in upstreams:
+                upstream_arr.append(upstream[0])
+
+            upstreams = self.select("SELECT Id1 FROM Sif_Relations WHERE Rel = 'controls-state-change-of' "
+                                    "AND Id2 = ? AND Id1 IN " + _json_list,
+                                    (gene, upstream_arr))
+
+
+        #format upstreams
+        upstream_list = []
+        for genes in upstreams:
+            upstream_list.append({'name': genes[0]})
+
+        return upstream_list
+
+    def find_mutex(self, gene, k=None):
+        """Find the mutually exclusive groups that include gene, best score
+        first, at most k of them if k is given"""
+        rows = self.select("SELECT g.Score, g.Genes FROM Mutex_Members m "
+                           "JOIN Mutex_Groups g ON g.GroupId = m.GroupId "
+                           "WHERE m.Gene = ? ORDER BY m.GroupId LIMIT ?",
+                           (gene, -1 if k is None else k))
+        return [self.row_to_mutex(row) for row in rows]
+
+    def find_mutex_many(self, genes, k=None):
+        """Find the mutually exclusive groups of each of genes with a single
+        query, returned as lists keyed by gene like find_mutex"""
+        mutexes = dict((gene, []) for gene in genes)
+        rows = self.select("SELECT m.Gene, g.Score, g.Genes FROM Mutex_Members m "
+                           "JOIN Mutex_Groups g ON g.GroupId = m.GroupId "
+                           "WHERE m.Gene IN " + _json_list + " ORDER BY m.Gene, m.GroupId",
+                           (list(genes),))
+        for row in rows:
+            gene_mutexes = mutexes[row[0]]
+            if k is None or len(gene_mutexes) < k:
+                gene_mutexes.append(self.row_to_mutex(row[1:]))
+        return mutexes
 
-
-                upstream_arr = []
-                for upstream in upstreams:
-                    upstream_arr.append(upstream[0])
-
-                query = "SELECT Id1 FROM Sif_Relations WHERE Rel = 'controls-state-change-of' AND Id2 = ? AND Id1 IN (" \
-                        + ", ".join((("'"+str(upstream)+"'") for upstream in upstream_arr)) + ")"
-
-                upstreams = cur.execute(query, (gene,)).fetchall()
-
-
-            #format upstreams
-            upstream_list = []
-            for genes in upstreams:
-                upstream_list.append({'name': genes[0]})
-
-            return upstream_list
-
-    #debug method
-    def find_all_correlations(self, gene):
-        with self.cadb:
-            cur = self.cadb.cursor()
-            rows = cur.execute("SELECT * FROM Correlations WHERE Id1 = ?  OR Id2 = ?",
-                               (gene, gene)).fetchall()
-            for row in rows:
-                print row[0], row[2]
-
-    def find_mutex(self, gene):
-        """Find a mutually exclusive group that includes gene"""
-
-        with self.cadb:
-            cur = self.cadb.cursor()
-            groups = cur.execute("SELECT * FROM Mutex WHERE Id1 = ? OR Id2 = ? OR Id3 = ?",
-                                 (gene, gene, gene)).fetchall()
-
-        # format groups
-        mutex_list = []
-        for group in groups:
-            mutex = {'group': [], 'score': group[len(group) - 1]}
-            for i in range(len(group) - 1):
-                mutex['group'].append(group[i])
-            mutex_list.append(mutex)
-
-        return mutex_list
+    @staticmethod
+    def row_to_mutex(row):
+        return {'group': json.loads(row[1]), 'score': row[0]}
 
 #test
 def print_result(res):
@@ -490,7 +1811,6 @@ def print_result(res):
 # db.find_next_correlation('AKT1',print_result)
 # # db.find_next_correlation('AKT1',print_result)
 # db.find_correlation_between('AKT1', 'BRAF')
-# db.find_all_correlations('AKT1')
 # print(db.find_mut_sig('TP53'))
 # db.find_common_upstreams('RAC1', 'RAC2')
 # db.find_common_upstreams(['AKT1', 'BRAF', 'MAPK1'], print_result)
@@ -0,0 +1,241 @@
+import os
+import time
+import array
+import bisect
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger('CausalityGraph')
+
+
+class SifGraph(object):
+    """In-memory reverse adjacency index over the Sif_Relations table.
+
+    Gene names are interned to integer ids and, for every relation type,
+    the upstreams of each gene are kept as a sorted array of ids so that
+    common upstream queries are intersections of sorted arrays.
+    """
+    def __init__(self, rows):
+        self.gene_ids = {}
+        self.gene_names = []
+
+        upstream_sets = {}
+        for id1, id2, rel in rows:
+            source = self.intern(id1)
+            target = self.intern(id2)
+            upstream_sets.setdefault(rel, {}).setdefault(target, set()).add(source)
+
+        self.upstreams = {}
+        for rel, targets in upstream_sets.items():
+            self.upstreams[rel] = dict((target, array.array('i', sorted(sources)))
+                                       for target, sources in targets.items())
+
+    def intern(self, gene):
+        gene_id = self.gene_ids.get(gene)
+        if gene_id is None:
+            gene_id = len(self.gene_names)
+            self.gene_ids[gene] = gene_id
+            self.gene_names.append(gene)
+        return gene_id
+
+    def get_upstream_ids(self, gene, rel):
+        gene_id = self.gene_ids.get(gene)
+        if gene_id is None:
+            return array.array('i')
+        return self.upstreams.get(rel, {}).get(gene_id, array.array('i'))
+
+    def find_common_upstreams(self, genes, rel='controls-state-change-of'):
+        """Return the names of the genes that have a rel edge to all genes"""
+        neighbors = sorted((self.get_upstream_ids(gene, rel) for gene in genes), key=len)
+        if not neighbors:
+            return []
+
+        common = neighbors[0]
+        for other in neighbors[1:]:
+            if not common:
+                break
+            common = [gene_id for gene_id in common if _contains(other, gene_id)]
+
+        return sorted(self.gene_names[gene_id] for gene_id in common)
+
+
+class CausalityGraph(object):
+    """In-memory index over the forward relations of the Causality table.
+
+    Nodes are interned genes; every edge keeps the Causality row it comes
+    from so that paths can be turned back into causality objects.
+    """
+    def __init__(self, rows):
+        self.gene_ids = {}
+        self.gene_names = []
+        self.rows = []
+        self.out_edges = {}
+        self.in_edges = {}
+
+        for row in rows:
+            source = self.intern(row[0])
+            target = self.intern(row[2])
+            if source == target:
+                continue
+            edge = len(self.rows)
+            self.rows.append(tuple(row))
+            self.out_edges.setdefault(source, []).append((target, edge))
+            self.in_edges.setdefault(target, []).append(source)
+
+    def intern(self, gene):
+        gene_id = self.gene_ids.get(gene)
+        if gene_id is None:
+            gene_id = len(self.gene_names)
+            self.gene_ids[gene] = gene_id
+            self.gene_names.append(gene)
+        return gene_id
+
+    def distances_to(self, targets, max_hops):
+        """Breadth-first search backwards from the targets, returning the
+        hop distance to the closest target of every node within max_hops"""
+        frontier = [self.gene_ids[gene] for gene in targets if gene in self.gene_ids]
+        distances = dict((gene_id, 0) for gene_id in frontier)
+        for hops in range(1, max_hops + 1):
+            next_frontier = []
+            for gene_id in frontier:
+                for source in self.in_edges.get(gene_id, []):
+                    if source not in distances:
+                        distances[source] = hops
+                        next_frontier.append(source)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return distances
+
+    def find_paths(self, sources, targets, max_hops=3, max_paths=10,
+                   time_budget=None):
+        """Return up to max_paths paths from any source to any target with
+        at most max_hops edges, shortest first.
+
+        Each path is a list of Causality rows. The search stops early once
+        time_budget seconds have passed, returning the paths found so far.
+        """
+        deadline = time.time() + time_budget if time_budget is not None else None
+        distances = self.distances_to(targets, max_hops)
+        target_ids = set(self.gene_ids[gene] for gene in targets if gene in self.gene_ids)
+        source_ids = [self.gene_ids[gene] for gene in sources
+                      if self.gene_ids.get(gene) in distances]
+
+        paths = []
+        for length in range(1, max_hops + 1):
+            for source in source_ids:
+                if distances[source] > length:
+                    continue
+                self._extend_paths(source, length, target_ids, distances,
+                                   [source], [], paths, max_paths, deadline)
+                if len(paths) >= max_paths or \
+                        (deadline is not None and time.time() > deadline):
+                    return paths
+        return paths
+
+    def _extend_paths(self, gene_id, hops_left, target_ids, distances,
+                      visited, edges, paths, max_paths, deadline):
+        # Depth-first walk that only steps to nodes still able to reach a
+        # target in the remaining hops, so every branch ends in a path
+        if hops_left == 0:
+            if gene_id in target_ids:
+                paths.append([self.rows[edge] for edge in edges])
+            return
+        if deadline is not None and time.time() > deadline:
+            return
+        for target, edge in self.out_edges.get(gene_id, []):
+            if len(paths) >= max_paths:
+                return
+            if target in visited or distances.get(target, hops_left) > hops_left - 1:
+                continue
+            # Paths through a target are already found with fewer hops
+            if target in target_ids and hops_left > 1:
+                continue
+            visited.append(target)
+            edges.append(edge)
+            self._extend_paths(target, hops_left - 1, target_ids, distances,
+                               visited, edges, paths, max_paths, deadline)
+            visited.pop()
+            edges.pop()
+
+
+class MutSigIndex(object):
+    """In-memory index of the significance level of each gene of the MutSig
+    table, the first row of a gene taking precedence"""
+    def __init__(self, rows):
+        self.levels = {}
+        for gene, level in rows:
+            self.levels.setdefault(gene, level)
+        self.gene_names = list(self.levels)
+
+
+def _contains(sorted_ids, gene_id):
+    ind = bisect.bisect_left(sorted_ids, gene_id)
+    return ind < len(sorted_ids) and sorted_ids[ind] == gene_id
+
+
+# Relations of the Causality table followed by path searches, the
+# is-...-by relations being their reverse
+_causal_rels = ['phosphorylates', 'dephosphorylates',
+                'upregulates-expression', 'downregulates-expression']
+
+# Graphs and indexes loaded in this process, keyed by their type, database
+# file and its mtime so that a rebuilt database is picked up
+_graphs = {}
+# Lock of each key held while its graph is loaded, so that loading a large
+# graph does not hold up the lookups of the others
+_graph_locks = {}
+_graphs_lock = threading.Lock()
+
+
+def _get_graph(db_file, graph_class, query):
+    key = (graph_class.__name__, os.path.realpath(db_file))
+    mtime = os.path.getmtime(db_file)
+    with _graphs_lock:
+        mtime_graph = _graphs.get(key)
+        if mtime_graph is not None and mtime_graph[0] == mtime:
+            return mtime_graph[1]
+        key_lock = _graph_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        # Loaded by another thread meanwhile
+        with _graphs_lock:
+            mtime_graph = _graphs.get(key)
+        if mtime_graph is None or mtime_graph[0] != mtime:
+            start = time.time()
+            cadb = sqlite3.connect(db_file)
+            try:
+                graph = graph_class(cadb.execute(query))
+            finally:
+                cadb.close()
+            logger.info('Loaded %s of %d genes in %.2f s' %
+                        (graph_class.__name__, len(graph.gene_names), time.time() - start))
+            mtime_graph = (mtime, graph)
+            with _graphs_lock:
+                _graphs[key] = mtime_graph
+        return mtime_graph[1]
+
+
+def get_sif_graph(db_file):
+    """Return the SifGraph of a database, loading it on first use.
+
+    The graph is shared by every agent of the process using the same
+    database.
+    """
+    return _get_graph(db_file, SifGraph, "SELECT Id1, Id2, Rel FROM Sif_Relations")
+
+
+def load_mut_sig_index(db_file):
+    """Load the MutSigIndex of a database"""
+    cadb = sqlite3.connect(db_file)
+    try:
+        return MutSigIndex(cadb.execute("SELECT Id, Level FROM MutSig ORDER BY rowid"))
+    finally:
+        cadb.close()
+
+
+def get_causality_graph(db_file):
+    """Return the CausalityGraph of a database, loading it on first use"""
+    rels = ", ".join("'%s'" % rel for rel in _causal_rels)
+    return _get_graph(db_file, CausalityGraph,
+                      "SELECT * FROM Causality WHERE Rel IN (%s) ORDER BY Seq" % rels)
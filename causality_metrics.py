@@ -0,0 +1,153 @@
+"""Timing spans, counters and latency histograms of the causality agents.
+
+Requests are timed with Metrics.task and the parts of a request (TRIPS
+parsing, SQL, INDRA conversion, serialization) with Metrics.span, which
+attribute their time to the task running on the thread. SQL executions
+slower than the slow query threshold are logged. The metrics can be
+dumped in the Prometheus text format.
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('CausalityMetrics')
+
+# Upper bounds in seconds of the latency histogram buckets
+_default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_help = {
+    'causality_requests_total': 'Requests handled, by task and status',
+    'causality_request_seconds': 'Time to handle a request, by task',
+    'causality_span_seconds': 'Time spent in each part of a request, by task and span',
+    'causality_sql_rows_total': 'Rows returned by SQL queries, by task',
+    'causality_slow_queries_total': 'SQL queries slower than the slow query threshold, by task',
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels) + '}'
+
+
+class Metrics(object):
+    """Thread-safe registry of counters and latency histograms"""
+    def __init__(self, buckets=_default_buckets, slow_query_threshold=0.1):
+        self.buckets = buckets
+        # SQL executions taking longer than this many seconds are logged
+        self.slow_query_threshold = slow_query_threshold
+        self.lock = threading.Lock()
+        # Values keyed by metric name and sorted tuple of label pairs
+        self.counters = {}
+        # Bucket counts followed by the sum and count of the observations
+        self.histograms = {}
+        self.local = threading.local()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [0] * (len(self.buckets) + 2)
+                self.histograms[key] = histogram
+            for ind, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[ind] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def current_task(self):
+        return getattr(self.local, 'task', '')
+
+    @contextmanager
+    def task(self, name):
+        """Time a request, attributing the spans run within it to the task"""
+        outer_task = self.current_task()
+        self.local.task = name
+        start = time.time()
+        status = 'failure'
+        try:
+            yield
+            status = 'success'
+        finally:
+            self.local.task = outer_task
+            self.observe('causality_request_seconds', time.time() - start, task=name)
+            self.inc('causality_requests_total', task=name, status=status)
+
+    @contextmanager
+    def span(self, name):
+        """Time a part of the current request"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe('causality_span_seconds', time.time() - start,
+                         task=self.current_task(), span=name)
+
+    def sql(self, query, seconds, rows):
+        """Record an SQL execution that returned rows rows"""
+        task = self.current_task()
+        self.observe('causality_span_seconds', seconds, task=task, span='sql')
+        self.inc('causality_sql_rows_total', rows, task=task)
+        if seconds > self.slow_query_threshold:
+            self.inc('causality_slow_queries_total', task=task)
+            logger.warning('Slow query in %s (%.1f ms, %d rows): %s' %
+                           (task or 'no task', seconds * 1e3, rows, ' '.join(query.split())))
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(histogram)) for key, histogram in self.histograms.items())
+
+        lines = []
+        written = set()
+
+        def header(name, metric_type):
+            if name not in written:
+                written.add(name)
+                if name in _help:
+                    lines.append('# HELP %s %s' % (name, _help[name]))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('%s%s %s' % (name, _format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            for bound, count in zip(self.buckets, histogram):
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', repr(bound)),)),
+                                                 count))
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', '+Inf'),)),
+                                             histogram[-1]))
+            lines.append('%s_sum%s %r' % (name, _format_labels(labels), histogram[-2]))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_path):
+        """Write the metrics to a file, e.g. one read by the textfile
+        collector of the Prometheus node exporter"""
+        tmp_file = file_path + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            fp.write(self.to_prometheus())
+        getattr(os, 'replace', os.rename)(tmp_file, file_path)
+
+
+# Metrics of the agents of the process
+metrics = Metrics()
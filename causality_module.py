@@ -1,13 +1,22 @@
+import time
+# Imports are the first part of the startup time report
+_import_start = time.time()
+import re
 import sys
 import os
 import json
+import hashlib
 import logging
+import threading
+from collections import OrderedDict
 from bioagents import Bioagent
 from causality_agent import CausalityAgent
+from causality_metrics import metrics
 from indra.sources.trips.processor import TripsProcessor
 from kqml import KQMLModule, KQMLPerformative, KQMLList, KQMLString, KQMLToken
 from bioagents.mra import MRA, MRA_Module
 from bioagents.mra.mra_module import ekb_from_agent, get_target
+_import_time = time.time() - _import_start
 
 logging.basicConfig(format='%(levelname)s: %(name)s - %(message)s',
                     level=logging.INFO)
@@ -15,20 +24,73 @@ logger = logging.getLogger('CausalA')
 
 _resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/resources/'
 
+_target_rel_map = {
+    "phosphorylation": "phosphorylates",
+    "dephosphorylation": "dephosphorylates",
+    "activate": "upregulates-expression",
+    "increase": "upregulates-expression",
+    "inhibit": "downregulates-expression",
+    "decrease": "downregulates-expression",
+    "modulate": "modulates",
+}
+
+
+def _task(*tables):
+    """Time a task in the metrics, and reply with a WARMING_UP failure
+    while the tables it reads are still being built, or a BUILD_FAILED
+    failure if they never will be"""
+    def decorator(respond):
+        task = respond.__name__[len('respond_'):].replace('_', '-').upper()
+
+        def wrapper(self, content):
+            with metrics.task(task):
+                if not self.CA.table_ready(*tables):
+                    if self.CA.build_failed(*tables):
+                        return self.make_failure('BUILD_FAILED')
+                    return self.make_failure('WARMING_UP')
+                return respond(self, content)
+        wrapper.__name__ = respond.__name__
+        wrapper.__doc__ = respond.__doc__
+        return wrapper
+    return decorator
+
 
 class CausalityModule(Bioagent):
     name = 'CausalA'
     tasks = ['FIND-CAUSAL-PATH', 'FIND-CAUSALITY-TARGET',
              'FIND-CAUSALITY-SOURCE',
              'DATASET-CORRELATED-ENTITY', 'FIND-COMMON-UPSTREAMS',
-             'RESTART-CAUSALITY-INDICES']
+             'RESTART-CAUSALITY-INDICES', 'FIND-CAUSALITY-TARGET-MANY',
+             'FIND-MUT-SIG-MANY', 'GET-METRICS', 'LOAD-DATASET',
+             'GET-DATASET-STATUS']
 
     def __init__(self, **kwargs):
-        self.CA = CausalityAgent(_resource_dir)
+        self.init_start = time.time()
+        self.ready_time = None
+        # Build the tables in the background so that the module registers
+        # with the facilitator right away
+        self.CA = CausalityAgent(_resource_dir, lazy=True,
+                                 on_ready=self.on_tables_ready)
         # Call the constructor of KQMLModule
         super(CausalityModule, self).__init__(**kwargs)
 
-
+    def startup_report(self):
+        """Return the seconds spent on imports, on building each table and
+        until all tables were ready"""
+        report = {'imports': _import_time}
+        if self.ready_time is not None:
+            report['ready'] = self.ready_time
+        report.update(('table ' + table, build_time)
+                      for table, build_time in self.CA.build_times.items())
+        return report
+
+    def on_tables_ready(self):
+        self.ready_time = time.time() - self.init_start
+        report = self.startup_report()
+        logger.info('Startup times: %s' %
+                    ', '.join('%s %.2f s' % (name, report[name]) for name in sorted(report)))
+
+    @_task('Causality')
     def respond_find_causal_path(self, content):
         """Response content to find-causal-path request"""
         source_arg = content.gets('SOURCE')
@@ -48,23 +110,33 @@ class CausalityModule(Bioagent):
         target = {'id': target_name, 'pSite': ''}
         source = {'id': source_name, 'pSite': ''}
 
-        result = self.CA.find_causality({'source': source, 'target': target})
+        result = self.CA.find_causality_indra({'source': source, 'target': target})
 
-        if not result:
-            reply = self.make_failure('NO_PATH_FOUND')
-            return reply
+        if result:
+            path = [result]
+        else:
+            # Look for an indirect path, of INDRA statements only
+            paths = self.CA.find_causal_paths_indra({'source': source, 'target': target})
+            if not paths:
+                reply = self.make_failure('NO_PATH_FOUND')
+                return reply
+            path = paths[0]
 
-        indra_json = json.dumps([make_indra_json(result)])
+        with metrics.span('json'):
+            indra_json = _join_json(indra_json for indra_json, _ in path)
 
         reply = KQMLList('SUCCESS')
         reply.sets('paths', indra_json)
 
         # Send PC links to provenance tab
-        self.send_provenance(result['uri_str'])
+        self.send_provenance([uri_id for _, uri_ids in path for uri_id in json.loads(uri_ids)])
 
         return reply
 
-    def send_provenance(self, uri_str):
+    def send_provenance(self, uri_ids):
+        """Send the Pathway Commons link of the provenance URIs with the
+        given ids to the provenance tab"""
+        uri_str = ''.join('uri=' + uri + '&' for uri in self.CA.find_provenance_uris(uri_ids))
         pc_url = 'http://www.pathwaycommons.org/pc2/get?' + uri_str + 'format=SBGN'
         html = '<a href= \'' + pc_url + '\' target= \'_blank\'> Click for Pathway Commons queries</a>'
         msg = KQMLPerformative('tell')
@@ -73,6 +145,7 @@ class CausalityModule(Bioagent):
         msg.set('content', content)
         self.send(msg)
 
+    @_task('Causality')
     def respond_find_causality_target(self, content):
         """Response content to find-causality-target request"""
         target_arg = content.gets('TARGET')
@@ -86,36 +159,41 @@ class CausalityModule(Bioagent):
             reply = self.make_failure('MISSING_MECHANISM')
             return reply
 
-        rel_map = {
-            "phosphorylation": "phosphorylates",
-            "dephosphorylation": "dephosphorylates",
-            "activate": "upregulates-expression",
-            "increase": "upregulates-expression",
-            "inhibit": "downregulates-expression",
-            "decrease": "downregulates-expression",
-            "modulate": "modulates",
-        }
-
-
         target = {'id': target_name, 'pSite': ' ',
-                  'rel': rel_map[rel]}
-        result = self.CA.find_causality_targets(target)
-
+                  'rel': _target_rel_map[rel]}
+        page = _get_page(content, target)
+        try:
+            result = self.find_targets_indra(target, page)
+        except ValueError as e:
+            logger.warning('Invalid page: %s' % e)
+            reply = self.make_failure('INVALID_PAGE')
+            return reply
 
         if not result:
             reply = self.make_failure('MISSING_MECHANISM')
             return reply
 
         # Send PC links to provenance tab
-        self.send_provenance(result['uri_str'])
+        self.send_provenance([uri_id for _, uri_ids in result for uri_id in json.loads(uri_ids)])
 
-        indra_json = json.dumps([make_indra_json(r) for r in result])
+        with metrics.span('json'):
+            indra_json = _join_json(indra_json for indra_json, _ in result)
 
         reply = KQMLList('SUCCESS')
         reply.sets('paths', indra_json)
+        _set_page(reply, page)
 
         return reply
 
+    def find_targets_indra(self, param, page):
+        """Return the INDRA JSON of the causal relationships of param, only
+        the requested page of them if the request is paged"""
+        if page is None:
+            return self.CA.find_causality_targets_indra(param)
+        page.update(self.CA.find_causality_targets_indra_page(param))
+        return page['targets']
+
+    @_task('Causality')
     def respond_find_causality_source(self, content):
         """Response content to find-qca-path request"""
         source_arg = content.gets('SOURCE')
@@ -143,76 +221,212 @@ class CausalityModule(Bioagent):
         source = {'id': source_name, 'pSite': ' ',
                   'rel': rel_map[rel]}
 
-        result = self.CA.find_causality_targets(source)
-
+        page = _get_page(content, source)
+        try:
+            result = self.find_targets_indra(source, page)
+        except ValueError as e:
+            logger.warning('Invalid page: %s' % e)
+            reply = self.make_failure('INVALID_PAGE')
+            return reply
 
         if not result:
             reply = self.make_failure('MISSING_MECHANISM')
             return reply
 
-        indra_json = json.dumps([make_indra_json(r) for r in result])
+        with metrics.span('json'):
+            indra_json = _join_json(indra_json for indra_json, _ in result)
 
         reply = KQMLList('SUCCESS')
         reply.sets('paths', indra_json)
+        _set_page(reply, page)
 
         return reply
 
-def _get_term_name(term_str):
-    tp = TripsProcessor(term_str)
-    terms = tp.tree.findall('TERM')
-    if not terms:
-        return None
-    term_id = terms[0].attrib['id']
-    agent = tp._get_agent_by_id(term_id, None)
-    if agent is None:
+    @_task('Causality')
+    def respond_find_causality_target_many(self, content):
+        """Response content to find-causality-target-many request, finding
+        the targets of a list of genes in one lookup"""
+        targets_arg = content.get('TARGETS')
+        rel = content.gets('TYPE')
+
+        if not targets_arg:
+            raise ValueError("Targets are empty")
+
+        target_names = [_get_term_name(target.string_value()) for target in targets_arg.data]
+        target_names = [name for name in target_names if name]
+        if not target_names:
+            reply = self.make_failure('MISSING_MECHANISM')
+            return reply
+
+        result = self.CA.find_causality_targets_many_indra(target_names, _target_rel_map[rel])
+
+        with metrics.span('json'):
+            indra_json = '{' + ', '.join(json.dumps(gene) + ': ' + _join_json(statements)
+                                         for gene, statements in sorted(result.items())) + '}'
+
+        reply = KQMLList('SUCCESS')
+        reply.sets('paths', indra_json)
+
+        return reply
+
+    @_task('MutSig')
+    def respond_find_mut_sig_many(self, content):
+        """Response content to find-mut-sig-many request"""
+        genes_arg = content.get('GENES')
+
+        if not genes_arg:
+            raise ValueError("Genes are empty")
+
+        genes = [gene.string_value() for gene in genes_arg.data]
+        result = self.CA.find_mut_sig_many(genes)
+
+        with metrics.span('json'):
+            mutsig_json = json.dumps(result)
+
+        reply = KQMLList('SUCCESS')
+        reply.sets('mutsig', mutsig_json)
+
+        return reply
+
+    @_task()
+    def respond_restart_causality_indices(self, content):
+        """Response content to restart-causality-indices request"""
+        self.CA.reset_cursors()
+        reply = KQMLList('SUCCESS')
+        return reply
+
+    @_task()
+    def respond_load_dataset(self, content):
+        """Response content to load-dataset request, building a dataset of
+        the correlations in a file of the resource directory in the
+        background"""
+        name = content.gets('NAME')
+        file_name = content.gets('FILE')
+
+        if not name:
+            raise ValueError("Name is empty")
+        if not file_name:
+            raise ValueError("File is empty")
+
+        try:
+            self.CA.add_dataset(name, file_name, on_ready=self.on_dataset_ready)
+        except ValueError as e:
+            logger.warning('Cannot load dataset %s: %s' % (name, e))
+            reply = self.make_failure('INVALID_DATASET')
+            return reply
+
+        reply = KQMLList('SUCCESS')
+        reply.set('status', self.CA.dataset_status(name))
+        return reply
+
+    def on_dataset_ready(self, name):
+        logger.info('Dataset %s is ready' % name)
+
+    @_task()
+    def respond_get_dataset_status(self, content):
+        """Response content to get-dataset-status request"""
+        name = content.gets('NAME')
+        status = self.CA.dataset_status(name)
+        if status is None:
+            reply = self.make_failure('UNKNOWN_DATASET')
+            return reply
+        reply = KQMLList('SUCCESS')
+        reply.set('status', status)
+        return reply
+
+    def respond_get_metrics(self, content):
+        """Response content to get-metrics request, with the metrics of the
+        module in the Prometheus text format"""
+        reply = KQMLList('SUCCESS')
+        reply.sets('metrics', metrics.to_prometheus())
+        return reply
+
+class TermNameCache(object):
+    """Thread-safe LRU cache of the agent names of EKB terms.
+
+    Entries are keyed by a hash of the whitespace-normalized EKB string and
+    expire ttl seconds after they were added.
+    """
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(term_str):
+        normalized = re.sub(r'>\s+<', '><', term_str.strip())
+        if not isinstance(normalized, bytes):
+            normalized = normalized.encode('utf-8')
+        return hashlib.sha1(normalized).hexdigest()
+
+    def get(self, key):
+        """Return (True, name) for a live entry, (False, None) otherwise"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                self.misses += 1
+                return False, None
+            # Re-insert to mark as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key, name):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (name, time.time())
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_term_name_cache = TermNameCache()
+
+
+def _join_json(fragments):
+    """Join JSON encoded statements into the JSON list of a reply"""
+    return '[' + ', '.join(fragments) + ']'
+
+
+def _get_page(content, param):
+    """Add the PAGE-SIZE and PAGE-TOKEN of a paged request to param and
+    return the page to fill in, or None if the request is not paged"""
+    page_size = content.gets('PAGE-SIZE')
+    page_token = content.gets('PAGE-TOKEN')
+    if page_size is None and page_token is None:
         return None
-    return agent.name
+    param['pageSize'] = page_size
+    param['pageToken'] = page_token
+    return {}
 
-def make_indra_json(causality):
-    """Convert causality response to indra format
-        Causality format is (id1, res1, pos1, id2,res2, pos2, rel)"""
-    # TODO: Do these special cases still need to be handled?
-    '''
-    if causality.pos1 == '':
-        causality.pos1 = None
-    if causality.pos2 == '':
-        causality.pos2 = None
-    if causality.res1 == '':
-        causality.res1 = None
-    if causality.res2 == '':
-        causality.res2 = None
-    '''
-
-    causality['rel'] = causality['rel'].upper()
-
-    indra_relation_map = {
-        "PHOSPHORYLATES": "Phosphorylation",
-        "IS-PHOSPHORYLATED-BY": "Phosphorylation",
-        "IS-DEPHOSPHORYLATED-BY": "Dephosphorylation",
-        "UPREGULATES-EXPRESSION": "IncreaseAmount",
-        "EXPRESSION-IS-UPREGULATED-BY": "IncreaseAmount",
-        "DOWNREGULATES-EXPRESSION": "DecreaseAmount",
-        "EXPRESSION-IS-DOWNREGULATED-BY": "DecreaseAmount"
-    }
-
-    rel_type = indra_relation_map[causality['rel']]
-
-    s, t = ('2', '1') if 'IS' in causality['rel'] else ('1', '2')
-    subj, obj = ('enz', 'sub') if 'PHOSPHO' in causality['rel'] else \
-                ('subj', 'obj')
-
-    if "PHOSPHO" in causality['rel']:  # phosphorylation
-        indra_json = {'type': rel_type,
-                      subj: {'name': causality['id%s' % s],
-                             'mods': causality['mods%s' % s]},
-                      obj: {'name': causality['id%s' % t]},
-                      'residue': causality['mods%s' % t][0]['residue'],
-                      'position': causality['mods%s' % t][0]['position']}
-    return indra_json
 
+def _set_page(reply, page):
+    """Add the total count and the token of the next page to the reply of
+    a paged request"""
+    if page is None:
+        return
+    reply.set('total', str(page['total']))
+    if page['nextPageToken'] is not None:
+        reply.sets('next-page-token', page['nextPageToken'])
 
 
 def _get_term_name(term_str):
+    key = TermNameCache.key(term_str)
+    found, name = _term_name_cache.get(key)
+    if not found:
+        with metrics.span('trips'):
+            name = _parse_term_name(term_str)
+        _term_name_cache.put(key, name)
+    return name
+
+
+def _parse_term_name(term_str):
     tp = TripsProcessor(term_str)
     terms = tp.tree.findall('TERM')
     if not terms:
@@ -223,48 +437,6 @@ def _get_term_name(term_str):
         return None
     return agent.name
 
-def make_indra_json(causality):
-    """Convert causality response to indra format
-        Causality format is (id1, res1, pos1, id2,res2, pos2, rel)"""
-    # TODO: Do these special cases still need to be handled?
-    '''
-    if causality.pos1 == '':
-        causality.pos1 = None
-    if causality.pos2 == '':
-        causality.pos2 = None
-    if causality.res1 == '':
-        causality.res1 = None
-    if causality.res2 == '':
-        causality.res2 = None
-    '''
-
-    causality['rel'] = causality['rel'].upper()
-
-    indra_relation_map = {
-        "PHOSPHORYLATES": "Phosphorylation",
-        "IS-PHOSPHORYLATED-BY": "Phosphorylation",
-        "IS-DEPHOSPHORYLATED-BY": "Dephosphorylation",
-        "UPREGULATES-EXPRESSION": "IncreaseAmount",
-        "EXPRESSION-IS-UPREGULATED-BY": "IncreaseAmount",
-        "DOWNREGULATES-EXPRESSION": "DecreaseAmount",
-        "EXPRESSION-IS-DOWNREGULATED-BY": "DecreaseAmount"
-    }
-
-    rel_type = indra_relation_map[causality['rel']]
-
-    s, t = ('2', '1') if 'IS' in causality['rel'] else ('1', '2')
-    subj, obj = ('enz', 'sub') if 'PHOSPHO' in causality['rel'] else \
-                ('subj', 'obj')
-
-    if "PHOSPHO" in causality['rel']:  # phosphorylation
-        indra_json = {'type': rel_type,
-                      subj: {'name': causality['id%s' % s],
-                             'mods': causality['mods%s' % s]},
-                      obj: {'name': causality['id%s' % t]},
-                      'residue': causality['mods%s' % t][0]['residue'],
-                      'position': causality['mods%s' % t][0]['position']}
-    return indra_json
-
 
 if __name__ == "__main__":
     CausalityModule(argv=sys.argv[1:])
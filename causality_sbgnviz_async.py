@@ -0,0 +1,182 @@
+"""Asyncio front end of the causality agent for SBGNViz.
+
+Serves the same events as causality_sbgnviz_interface, but on an asyncio
+event loop with python-socketio instead of the blocking socketIO_client.
+Database work runs on a thread pool so that one event loop can serve many
+rooms, and lost connections are retried with exponential backoff. Requires
+Python 3.
+"""
+import os
+import sys
+import uuid
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import causality_agent
+from causality_sbgnviz_events import find_causality, find_causality_targets, find_causality_targets_many, \
+    find_causality_targets_page, find_next_correlation, load_dataset
+from causality_metrics import metrics
+
+logger = logging.getLogger('CausalitySbgnvizAsync')
+
+_resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/resources/'
+
+
+def _socketio_client():
+    import socketio
+    return socketio.AsyncClient(reconnection=False)
+
+
+class CausalitySbgnvizAsyncInterface(object):
+    """Connection of the causality agent to one SBGNViz room.
+
+    Several interfaces can share a CausalityAgent and an executor and run
+    on the same event loop, one per room.
+    """
+    def __init__(self, ca, executor, sbgnviz_url='http://localhost:3000',
+                 room_id=None, client_factory=_socketio_client,
+                 min_backoff=0.125, max_backoff=30.0):
+        self.CA = ca
+        self.executor = executor
+        self.sbgnviz_url = sbgnviz_url
+        self.user_id = '%s' % uuid.uuid4()
+        self.user_name = 'CA'
+        self.color_code = '#ff46a7'
+        # The room to join, or None for the current room of the server
+        self.requested_room_id = room_id
+        self.room_id = ''
+        self.client_factory = client_factory
+        self.client = None
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stopped = False
+
+    async def run(self):
+        """Stay connected until stop is called, reconnecting with
+        exponential backoff whenever the connection fails or drops"""
+        backoff = self.min_backoff
+        while not self.stopped:
+            try:
+                await self.connect_sbgnviz()
+                backoff = self.min_backoff
+                await self.client.wait()
+            except Exception as e:
+                logger.warning('SBGNViz connection failed: %s' % e)
+            if self.stopped:
+                break
+            logger.info('Reconnecting in %.2f s' % backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+
+    async def stop(self):
+        self.stopped = True
+        if self.client is not None:
+            await self.client.disconnect()
+        # The walks of the room are not resumed by anyone else
+        if self.room_id:
+            self.CA.reset_cursors(self.room_id)
+
+    async def connect_sbgnviz(self):
+        self.client = self.client_factory()
+        self.client.on('findCausality', self.on_find_causality)
+        self.client.on('findCausalityTargets', self.on_find_causality_targets)
+        self.client.on('findCausalityTargetsPage', self.on_find_causality_targets_page)
+        self.client.on('findCausalityTargetsMany', self.on_find_causality_targets_many)
+        self.client.on('findMutSigMany', self.on_find_mut_sig_many)
+        self.client.on('findCorrelation', self.on_find_next_correlation)
+        self.client.on('findCommonUpstreams', self.on_find_common_upstreams)
+        self.client.on('getMetrics', self.on_get_metrics)
+        self.client.on('loadDataset', self.on_load_dataset)
+        self.client.on('getDatasetStatus', self.on_get_dataset_status)
+        await self.client.connect(self.sbgnviz_url)
+
+        room = self.requested_room_id
+        if room is None:
+            room = await self.client.call('agentCurrentRoomRequest')
+        if room is None:
+            await self.client.disconnect()
+            raise ConnectionError('No SBGNViz room to join')
+        if self.room_id and room != self.room_id:
+            self.CA.reset_cursors(self.room_id)
+        self.room_id = room
+
+        user_info = {'userName': self.user_name,
+                     'room': self.room_id,
+                     'userId': self.user_id,
+                     'colorCode': self.color_code}
+        await self.client.emit('subscribeAgent', user_info)
+        await self.client.emit('agentNewFileRequest', {'room': self.room_id})
+        await self.client.emit('agentConnectToTripsRequest', user_info)
+        logger.info('Connected %s' % self.room_id)
+
+    async def run_in_executor(self, event, fun, *args):
+        """Run fun(*args) on the executor, timed as the task of event"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, _run_task, event, fun, args)
+
+    # The values returned by the handlers are sent back as the callbacks of
+    # the events
+    async def on_find_causality_targets(self, params):
+        return await self.run_in_executor('findCausalityTargets', find_causality_targets, self.CA, params)
+
+    async def on_find_causality_targets_page(self, params):
+        return await self.run_in_executor('findCausalityTargetsPage', find_causality_targets_page, self.CA,
+                                          params)
+
+    async def on_find_causality_targets_many(self, params):
+        return await self.run_in_executor('findCausalityTargetsMany', find_causality_targets_many, self.CA,
+                                          params)
+
+    async def on_find_mut_sig_many(self, params):
+        return await self.run_in_executor('findMutSigMany', self.CA.find_mut_sig_many, params)
+
+    async def on_find_causality(self, params):
+        return await self.run_in_executor('findCausality', find_causality, self.CA, params)
+
+    async def on_find_next_correlation(self, params):
+        return await self.run_in_executor('findCorrelation', find_next_correlation, self.CA, params,
+                                          self.room_id)
+
+    async def on_find_common_upstreams(self, params):
+        return await self.run_in_executor('findCommonUpstreams', self.CA.find_common_upstreams, params)
+
+    async def on_get_metrics(self, params):
+        return metrics.to_prometheus()
+
+    async def on_load_dataset(self, params):
+        return await self.run_in_executor('loadDataset', load_dataset, self.CA, params)
+
+    async def on_get_dataset_status(self, name):
+        return {'name': name, 'status': self.CA.dataset_status(name)}
+
+
+def _run_task(event, fun, args):
+    # The error is sent back as the callback, as by the blocking front end,
+    # since no callback at all is sent for a handler that raises
+    try:
+        with metrics.task(event):
+            return fun(*args)
+    except Exception:
+        logger.exception('Failed to handle %s' % event)
+        return {'error': 'Failed to handle %s' % event}
+
+
+async def serve_rooms(path, room_ids=(None,), sbgnviz_url='http://localhost:3000',
+                      max_workers=4):
+    """Serve the given rooms from one event loop, sharing one agent"""
+    ca = causality_agent.CausalityAgent(path)
+    executor = ThreadPoolExecutor(max_workers)
+    interfaces = [CausalitySbgnvizAsyncInterface(ca, executor, sbgnviz_url, room_id)
+                  for room_id in room_ids]
+    try:
+        await asyncio.gather(*[interface.run() for interface in interfaces])
+    finally:
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    path = _resource_dir if len(sys.argv) == 1 else sys.argv[1]
+    try:
+        asyncio.run(serve_rooms(path))
+    except KeyboardInterrupt:
+        pass
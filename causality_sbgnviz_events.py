@@ -0,0 +1,61 @@
+"""Handlers of the SBGNViz events whose params need unpacking, shared by
+the blocking and the asyncio front ends of the causality agent."""
+
+
+def find_causality(ca, params):
+    """Answer a findCausality event, with the provenance URIs of the
+    relationship found"""
+    causality = ca.find_causality(params)
+    if causality:
+        ca.add_provenance([causality])
+    return causality
+
+
+def find_causality_targets(ca, params):
+    """Answer a findCausalityTargets event, with the provenance URIs of the
+    relationships found"""
+    return ca.add_provenance(ca.find_causality_targets(params))
+
+
+def find_causality_targets_many(ca, params):
+    """Answer a findCausalityTargetsMany event, whose params are the genes
+    and the relation, with the provenance URIs of the relationships found"""
+    targets = ca.find_causality_targets_many(params.get('id'), params.get('rel'))
+    ca.add_provenance([causality for gene_targets in targets.values() for causality in gene_targets])
+    return targets
+
+
+def find_next_correlation(ca, params, session_id):
+    """Answer a findCorrelation event, whose params are a gene or a dict of
+    the gene and the name of the dataset to look in"""
+    if isinstance(params, dict):
+        return ca.find_next_correlation(params.get('gene'), session_id, params.get('dataset'))
+    return ca.find_next_correlation(params, session_id)
+
+
+def find_causality_targets_page(ca, params):
+    """Answer a findCausalityTargetsPage event, with the provenance URIs of
+    the relationships found, replying with the error if the page size or
+    token are not valid"""
+    try:
+        page = ca.find_causality_targets_page(params)
+    except ValueError as e:
+        return {'error': str(e)}
+    ca.add_provenance(page['targets'])
+    return page
+
+
+def load_dataset(ca, params):
+    """Answer a loadDataset event, whose params are the name of the new
+    dataset and either the name of its correlation file in the resource
+    directory or its content"""
+    name = params.get('name')
+    content = params.get('content')
+    try:
+        if content is not None:
+            ca.add_dataset(name, lines=content.splitlines(True))
+        else:
+            ca.add_dataset(name, params.get('file'))
+    except ValueError as e:
+        return {'name': name, 'error': str(e)}
+    return {'name': name, 'status': ca.dataset_status(name)}
@@ -3,15 +3,93 @@ import sys
 import uuid
 from socketIO_client import SocketIO
 import causality_agent
+from causality_sbgnviz_events import find_causality, find_causality_targets, find_causality_targets_many, \
+    find_causality_targets_page, find_next_correlation, load_dataset
+from causality_metrics import metrics
 import os
 import threading
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger('CausalitySbgnvizInterface')
 
 _resource_dir = os.path.dirname(os.path.realpath(__file__)) + '/resources/'
 
+
+class RequestDispatcher(object):
+    """Runs event handlers on a bounded pool of worker threads.
+
+    Requests wait in a queue of at most max_queue entries. Once it is full,
+    new requests are rejected right away rather than letting the latency of
+    every request grow.
+    """
+    def __init__(self, max_workers=4, max_queue=64):
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        # Per event counts of queued, completed, failed and rejected
+        # requests, and the highest number queued at once
+        self.metrics = {}
+        self.workers = []
+        for i in range(max_workers):
+            worker = threading.Thread(target=self.work, name='CausalityWorker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def event_metrics(self, event):
+        return self.metrics.setdefault(event, {'queued': 0, 'max_queued': 0, 'completed': 0,
+                                               'failed': 0, 'rejected': 0})
+
+    def submit(self, event, handler, params, callback):
+        """Queue handler(params) to be run by a worker, which then passes the
+        result to callback. Returns False if the queue is full."""
+        with self.lock:
+            metrics = self.event_metrics(event)
+            try:
+                self.queue.put_nowait((event, handler, params, callback))
+            except queue.Full:
+                metrics['rejected'] += 1
+                return False
+            metrics['queued'] += 1
+            metrics['max_queued'] = max(metrics['max_queued'], metrics['queued'])
+        return True
+
+    def work(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                break
+            event, handler, params, callback = request
+            with self.lock:
+                self.event_metrics(event)['queued'] -= 1
+            try:
+                with metrics.task(event):
+                    res = handler(params)
+            except Exception:
+                logger.exception('Failed to handle %s' % event)
+                with self.lock:
+                    self.event_metrics(event)['failed'] += 1
+                callback({'error': 'Failed to handle %s' % event})
+                continue
+            with self.lock:
+                self.event_metrics(event)['completed'] += 1
+            callback(res)
+
+    def get_metrics(self):
+        with self.lock:
+            return dict((event, dict(metrics)) for event, metrics in self.metrics.items())
+
+    def stop(self):
+        for worker in self.workers:
+            self.queue.put(None)
+
+
 class CausalitySbgnvizInterface(object):
 
-    def __init__(self, sbgnviz_port = 3000):
+    def __init__(self, sbgnviz_port = 3000, max_workers=4, max_queue=64):
         self.sbgnviz_port = sbgnviz_port
         self.user_id = '%s' % uuid.uuid4()
         self.user_name = 'CA'
@@ -24,6 +102,9 @@ class CausalitySbgnvizInterface(object):
             path = sys.argv[1]
 
         self.CA = causality_agent.CausalityAgent(path)
+        self.dispatcher = RequestDispatcher(max_workers, max_queue)
+        # Callbacks are sent from the worker threads
+        self.callback_lock = threading.Lock()
         self.connect_sbgnviz()
 
 
@@ -37,6 +118,9 @@ class CausalitySbgnvizInterface(object):
                 self.socket_s.wait(seconds=0.1)
             except KeyboardInterrupt:
                 break
+        self.dispatcher.stop()
+        # The walks of the room are not resumed by anyone else
+        self.CA.reset_cursors(self.room_id)
         self.socket_s.emit('disconnect')
         self.socket_s.disconnect()
 
@@ -55,7 +139,8 @@ class CausalitySbgnvizInterface(object):
             threading.Timer(0.125, self.connect_sbgnviz).start()
             # return
         else:
-
+            if self.room_id and room != self.room_id:
+                self.CA.reset_cursors(self.room_id)
             self.room_id = room
 
             user_info = {'userName': self.user_name,
@@ -66,8 +151,14 @@ class CausalitySbgnvizInterface(object):
             # self.socket_s.on('message', self.on_sbgnviz_message)
             self.socket_s.on('findCausality', self.on_find_causality)
             self.socket_s.on('findCausalityTargets',self.on_find_causality_targets)
+            self.socket_s.on('findCausalityTargetsPage', self.on_find_causality_targets_page)
+            self.socket_s.on('findCausalityTargetsMany', self.on_find_causality_targets_many)
+            self.socket_s.on('findMutSigMany', self.on_find_mut_sig_many)
             self.socket_s.on('findCorrelation', self.on_find_next_correlation)
             self.socket_s.on('findCommonUpstreams', self.on_find_common_upstreams)
+            self.socket_s.on('getMetrics', self.on_get_metrics)
+            self.socket_s.on('loadDataset', self.on_load_dataset)
+            self.socket_s.on('getDatasetStatus', self.on_get_dataset_status)
             self.socket_s.on('reconnect', self.connect_sbgnviz)
             self.socket_s.emit(event, user_info)
             self.socket_s.emit('agentNewFileRequest', {'room': self.room_id})
@@ -78,21 +169,55 @@ class CausalitySbgnvizInterface(object):
     def on_user_list(self, user_list):
         self.current_users = user_list
 
+    def dispatch(self, event, handler, params, callback):
+        """Handle an event on a worker thread, replying through callback"""
+        def reply(res):
+            with self.callback_lock:
+                callback(res)
+
+        if not self.dispatcher.submit(event, handler, params, reply):
+            logger.warning('Rejected %s, too many requests queued' % event)
+            reply({'error': 'Too many requests, try again later'})
+
     def on_find_causality_targets(self, params, callback):
-        res = self.CA.find_causality_targets(params)
-        callback(res)
+        self.dispatch('findCausalityTargets', lambda p: find_causality_targets(self.CA, p), params, callback)
+
+    def on_find_causality_targets_page(self, params, callback):
+        self.dispatch('findCausalityTargetsPage', lambda p: find_causality_targets_page(self.CA, p),
+                      params, callback)
+
+    def on_find_causality_targets_many(self, params, callback):
+        self.dispatch('findCausalityTargetsMany', lambda p: find_causality_targets_many(self.CA, p),
+                      params, callback)
+
+    def on_find_mut_sig_many(self, params, callback):
+        self.dispatch('findMutSigMany', self.CA.find_mut_sig_many, params, callback)
 
     def on_find_causality(self, params, callback):
-        res = self.CA.find_causality(params)
-        callback(res)
+        self.dispatch('findCausality', lambda p: find_causality(self.CA, p), params, callback)
 
     def on_find_next_correlation(self, params, callback):
-        res = self.CA.find_next_correlation(params)
-        callback(res)
+        room_id = self.room_id
+        self.dispatch('findCorrelation',
+                      lambda p: find_next_correlation(self.CA, p, room_id),
+                      params, callback)
 
     def on_find_common_upstreams(self, params, callback):
-        res = self.CA.find_common_upstreams(params)
-        callback(res)
+        self.dispatch('findCommonUpstreams', self.CA.find_common_upstreams, params, callback)
+
+    def on_get_metrics(self, params, callback):
+        """Reply with the metrics in the Prometheus text format"""
+        with self.callback_lock:
+            callback(metrics.to_prometheus())
+
+    def on_load_dataset(self, params, callback):
+        """Start building a dataset in the background, replying with its
+        status right away"""
+        self.dispatch('loadDataset', lambda p: load_dataset(self.CA, p), params, callback)
+
+    def on_get_dataset_status(self, name, callback):
+        with self.callback_lock:
+            callback({'name': name, 'status': self.CA.dataset_status(name)})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,189 @@
+"""Memory-mapped columnar store of the PNNL correlations.
+
+The correlations are kept as NumPy arrays saved in a directory: interned
+gene and site ids, float32 correlations and p-values, and the correlations
+of each gene ranked for the next-correlation walk, indexed by CSR offsets.
+The arrays are memory-mapped when the store is opened, so opening it costs
+little more than reading the gene and site names. Requires numpy.
+"""
+import os
+import json
+import array
+import shutil
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bumped whenever the layout of the store changes
+_store_version = 1
+
+_id_columns = ['id1', 'site1', 'id2', 'site2']
+_value_columns = ['corr', 'p_val']
+
+
+def read_sources(store_dir):
+    """Return the source hashes a store was built from, or None if there is
+    no store of the current version in store_dir"""
+    try:
+        with open(os.path.join(store_dir, 'sources.json')) as fp:
+            meta = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+    if meta.get('version') != _store_version:
+        return None
+    return meta['sources']
+
+
+def build_store(store_dir, rows, sources):
+    """Build a store from (Id1, PSite1, Id2, PSite2, Corr, PVal, Explained)
+    rows of the Correlations table.
+
+    sources are recorded to be returned by read_sources. The store is
+    written into a temporary directory next to store_dir and then moved in
+    place. Concurrent builds of the same store are to be serialized by the
+    caller.
+    """
+    genes = {}
+    sites = {}
+    ids = dict((column, array.array('i')) for column in _id_columns)
+    values = dict((column, array.array('f')) for column in _value_columns)
+    explained = array.array('b')
+    for row in rows:
+        ids['id1'].append(genes.setdefault(row[0], len(genes)))
+        ids['site1'].append(sites.setdefault(row[1], len(sites)))
+        ids['id2'].append(genes.setdefault(row[2], len(genes)))
+        ids['site2'].append(sites.setdefault(row[3], len(sites)))
+        values['corr'].append(row[4])
+        values['p_val'].append(row[5])
+        explained.append(row[6])
+
+    columns = dict((column, np.frombuffer(ids[column], dtype=np.int32)) for column in ids)
+    columns.update((column, np.frombuffer(values[column], dtype=np.float32)) for column in values)
+    columns['ranked'], columns['offsets'] = _rank(columns, np.frombuffer(explained, dtype=np.int8),
+                                                  len(genes))
+
+    # A directory of its own, so that builds of the same store do not
+    # write into each other's files
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(store_dir) + '.', suffix='.tmp',
+                               dir=os.path.dirname(os.path.abspath(store_dir)))
+    try:
+        os.chmod(tmp_dir, 0o755)
+        for column, values in columns.items():
+            np.save(os.path.join(tmp_dir, column + '.npy'), values)
+        with open(os.path.join(tmp_dir, 'names.json'), 'w') as fp:
+            json.dump({'genes': _names(genes), 'sites': _names(sites)}, fp)
+        with open(os.path.join(tmp_dir, 'sources.json'), 'w') as fp:
+            json.dump({'version': _store_version, 'sources': sources}, fp)
+
+        # Open stores keep reading the unlinked files of the old one
+        if os.path.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.rename(tmp_dir, store_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def _names(ids):
+    names = [None] * len(ids)
+    for name, name_id in ids.items():
+        names[name_id] = name
+    return names
+
+
+def _rank(columns, explained, gene_count):
+    """Return the correlation indices grouped by gene and explained flag,
+    each group ranked like Ranked_Correlations, and the group offsets.
+
+    The group of a gene and flag is ranked[offsets[2 * gene + flag]:
+    offsets[2 * gene + flag + 1]].
+    """
+    count = len(columns['corr'])
+    indices = np.arange(count, dtype=np.int32)
+    # A correlation is in the groups of both its genes
+    other = columns['id2'] != columns['id1']
+    gene = np.concatenate([columns['id1'], columns['id2'][other]])
+    index = np.concatenate([indices, indices[other]])
+    side = np.concatenate([np.zeros(count, dtype=np.int8), np.ones(int(other.sum()), dtype=np.int8)])
+    group = gene.astype(np.int64) * 2 + explained[index]
+
+    # Highest absolute correlation first, ties in the order of the rows of
+    # Ranked_Correlations
+    order = np.lexsort((index, side, -np.abs(columns['corr'][index]), group))
+    counts = np.bincount(group, minlength=2 * gene_count)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return index[order], offsets
+
+
+def _to_float(value):
+    # The shortest repr of a float32 gives back the value of the source file
+    return float(str(value))
+
+
+class CorrelationStore(object):
+    """Read-only view of a store built with build_store"""
+    def __init__(self, store_dir):
+        if np is None:
+            raise ImportError('The correlation store requires numpy')
+        with open(os.path.join(store_dir, 'names.json')) as fp:
+            names = json.load(fp)
+        self.genes = names['genes']
+        self.sites = names['sites']
+        self.gene_ids = dict((gene, gene_id) for gene_id, gene in enumerate(self.genes))
+        self.site_ids = dict((site, site_id) for site_id, site in enumerate(self.sites))
+
+        for column in _id_columns + _value_columns + ['ranked', 'offsets']:
+            setattr(self, column, np.load(os.path.join(store_dir, column + '.npy'), mmap_mode='r'))
+
+    def row(self, ind):
+        """Return correlation ind as a row of the Correlations table"""
+        return (self.genes[self.id1[ind]], self.sites[self.site1[ind]],
+                self.genes[self.id2[ind]], self.sites[self.site2[ind]],
+                _to_float(self.corr[ind]), _to_float(self.p_val[ind]))
+
+    def gene_group(self, gene_id, first_flag, last_flag):
+        start = self.offsets[2 * gene_id + first_flag]
+        end = self.offsets[2 * gene_id + last_flag + 1]
+        return self.ranked[start:end]
+
+    def next_ranked(self, gene, explained, position=None):
+        """Return the correlation of gene after position in its explained
+        or unexplained walk, along with the position to continue from.
+
+        Returns (None, position) at the end of the walk.
+        """
+        gene_id = self.gene_ids.get(gene)
+        if gene_id is None:
+            return None, position
+        group = self.gene_group(gene_id, int(explained), int(explained))
+        start = 0 if position is None else position
+        if start >= len(group):
+            return None, position
+        return self.row(group[start]), start + 1
+
+    def get_correlation_between(self, gene1, p_site1, gene2, p_site2):
+        """Return the first correlation from site 1 to site 2, or else from
+        site 2 to site 1, or None"""
+        gene_id1 = self.gene_ids.get(gene1)
+        gene_id2 = self.gene_ids.get(gene2)
+        site_id1 = self.site_ids.get(p_site1)
+        site_id2 = self.site_ids.get(p_site2)
+        if None in (gene_id1, gene_id2, site_id1, site_id2):
+            return None
+
+        candidates = self.gene_group(gene_id1, 0, 1)
+        id1 = self.id1[candidates]
+        site1 = self.site1[candidates]
+        id2 = self.id2[candidates]
+        site2 = self.site2[candidates]
+        forward = (id1 == gene_id1) & (site1 == site_id1) & (id2 == gene_id2) & (site2 == site_id2)
+        backward = (id1 == gene_id2) & (site1 == site_id2) & (id2 == gene_id1) & (site2 == site_id1)
+        # A correlation in the requested direction comes first
+        for mask in (forward, backward):
+            matches = candidates[mask]
+            if len(matches):
+                return self.row(matches.min())
+        return None
@@ -1,14 +1,45 @@
+import os
 import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import multiprocessing
 from kqml import KQMLList
 from indra.statements import stmts_from_json
 from causality_sbgnviz_interface import _resource_dir
 import causality_agent
-from causality_module import CausalityModule
+from causality_module import CausalityModule, TermNameCache
 from tests.integration import _IntegrationTest
 from tests.util import ekb_kstring_from_text, get_request
 
 ca = causality_agent.CausalityAgent(_resource_dir)
 
+# Lines kept of the large resource files by make_build_dir
+_build_dir_lines = 500
+
+
+def make_build_dir():
+    """Return a new resource directory with small copies of the resource
+    files: all causal relationships, mutex groups and AKT1 correlations,
+    and the first lines of the other files"""
+    build_dir = tempfile.mkdtemp()
+    for source in ['causative-data-centric.sif', 'ranked-groups.txt']:
+        shutil.copy(os.path.join(_resource_dir, source), build_dir)
+    for source in ['PNNL-ovarian-correlations.txt', 'scores-mutsig.txt', 'PC.sif']:
+        with open(os.path.join(_resource_dir, source)) as fp:
+            lines = [line for ind, line in enumerate(fp)
+                     if ind < _build_dir_lines or (source.startswith('PNNL') and 'AKT1-' in line)]
+        with open(os.path.join(build_dir, source), 'w') as fp:
+            fp.writelines(lines)
+    return build_dir
+
+
+def akt1_correlation_lines(build_dir):
+    with open(os.path.join(build_dir, 'PNNL-ovarian-correlations.txt')) as fp:
+        return [line for line in fp if line.startswith('AKT1-')]
+
 def test_find_causality_targets_akt():
     def check(res):
         assert res == []
@@ -53,6 +84,453 @@ def test_find_next_correlation_akt():
     print(res)
 
 
+def test_indexes_created():
+    rows = ca.cadb.execute("SELECT name FROM sqlite_master "
+                           "WHERE type = 'index' AND tbl_name = 'Causality_Relations'").fetchall()
+    assert set(r[0] for r in rows) == {'Causality_Relations_Id1_Rel', 'Causality_Relations_Id2_Rel'}
+
+
+def test_opposite_relations_and_provenance():
+    relations = ca.select("SELECT COUNT(*) FROM Causality_Relations")[0][0]
+    assert ca.select("SELECT COUNT(*) FROM Causality")[0][0] == 2 * relations
+
+    forward = ca.find_causality({'source': {'id': 'MAPK1'}, 'target': {'id': 'JUND'}})
+    opposite = ca.find_causality({'source': {'id': 'JUND'}, 'target': {'id': 'MAPK1'}})
+    assert opposite['rel'] == 'is-phosphorylated-by'
+    assert opposite['uri_ids'] == forward['uri_ids']
+
+    with open(os.path.join(_resource_dir, 'causative-data-centric.sif')) as fp:
+        for line in fp:
+            vals = line.rstrip('\n').split('\t')
+            if vals[0].startswith('MAPK1-') and vals[2].startswith('JUND-'):
+                break
+    uris = ca.find_provenance_uris(forward['uri_ids'] + forward['uri_ids'])
+    assert uris == vals[3].split(' ')
+    # SBGNViz clients get the URIs as the uri_str of before they were interned
+    assert ca.add_provenance([forward])[0]['uri_str'] == ''.join('uri= ' + uri + '&' for uri in uris)
+
+
+def test_stored_sites_and_indra_json():
+    for row in ca.select("SELECT * FROM Causality"):
+        assert (row[6], row[7]) == causality_agent._parse_sites(row[1])
+        assert (row[8], row[9]) == causality_agent._parse_sites(row[3])
+        try:
+            indra_json = causality_agent.make_indra_json(ca.row_to_causality(row))
+        except (KeyError, IndexError):
+            assert row[10] is None
+        else:
+            assert json.loads(row[10]) == indra_json
+
+
+def test_find_causality_targets_many_indra():
+    res = ca.find_causality_targets_many_indra(['MAPK1', 'BRAF'], 'phosphorylates')
+    assert res['MAPK1'] == [indra_json for indra_json, _ in
+                            ca.find_causality_targets_indra({'id': 'MAPK1', 'rel': 'phosphorylates'})]
+    assert res['BRAF'] == [indra_json for indra_json, _ in
+                           ca.find_causality_targets_indra({'id': 'BRAF', 'rel': 'phosphorylates'})]
+
+
+def test_find_causal_paths_indra():
+    param = {'source': {'id': 'MAPK1'}, 'target': {'id': 'JUND'}}
+    causality = ca.find_causality(param)
+    indra_json, uri_ids = ca.find_causality_indra(param)
+    assert json.loads(indra_json) == causality_agent.make_indra_json(causality)
+    assert json.loads(uri_ids) == causality['uri_ids']
+    paths = ca.find_causal_paths_indra(param)
+    assert [[(json.loads(indra_json), json.loads(uri_ids)) for indra_json, uri_ids in path]
+            for path in paths] == \
+        [[(causality_agent.make_indra_json(c), c['uri_ids']) for c in path]
+         for path in ca.find_causal_paths(param)]
+
+    # Relationships without an INDRA statement are not part of the replies
+    pair = ca.select("SELECT Id1, Id2 FROM Causality GROUP BY Id1, Id2 HAVING COUNT(IndraJson) = 0 LIMIT 1")
+    if pair:
+        param = {'source': {'id': pair[0][0]}, 'target': {'id': pair[0][1]}}
+        assert ca.find_causality_indra(param) is None
+        for path in ca.find_causal_paths_indra(param):
+            assert all(indra_json is not None for indra_json, _ in path)
+
+
+def test_explained_flag_views():
+    explained, total = ca.cadb.execute("SELECT SUM(Explained), COUNT(*) FROM Correlations").fetchone()
+    unexplained = ca.cadb.execute("SELECT COUNT(*) FROM Unexplained_Correlations").fetchone()[0]
+    assert unexplained == total - explained
+    rows = ca.cadb.execute("SELECT Explained FROM Explained_Correlations").fetchall()
+    assert len(rows) == explained and all(row[0] for row in rows)
+
+
+def test_manifest_up_to_date():
+    network_manifest = causality_agent.read_manifest(ca.network_file)
+    assert set(network_manifest.keys()) == {'causative-data-centric.sif',
+                                            'scores-mutsig.txt', 'PC.sif',
+                                            'ranked-groups.txt'}
+    dataset_manifest = causality_agent.read_manifest(ca.dataset_file('pnnl'))
+    assert set(dataset_manifest.keys()) == {'PNNL-ovarian-correlations.txt',
+                                            'causative-data-centric.sif'}
+    for manifest in (network_manifest, dataset_manifest):
+        for source, entry in manifest.items():
+            path = os.path.join(_resource_dir, source)
+            assert causality_agent.source_entry(path, entry) == entry
+
+
+def test_datasets_share_network():
+    build_dir = make_build_dir()
+    try:
+        lines = akt1_correlation_lines(build_dir)[1:]
+        with open(os.path.join(build_dir, 'akt1-correlations.txt'), 'w') as fp:
+            fp.writelines(lines)
+
+        datasets = {'pnnl': 'PNNL-ovarian-correlations.txt', 'akt1': 'akt1-correlations.txt'}
+        multi_ca = causality_agent.CausalityAgent(build_dir, datasets=datasets)
+        assert multi_ca.list_datasets() == ['akt1', 'pnnl']
+        assert multi_ca.select("SELECT COUNT(*) FROM akt1.Correlations")[0][0] == len(lines)
+        assert multi_ca.find_next_correlation('AKT1', 's') == ca.find_next_correlation('AKT1', 's')
+        akt1_corr = multi_ca.find_next_correlation('AKT1', 's', 'akt1')
+        assert akt1_corr['id1'] == 'AKT1'
+        assert akt1_corr == multi_ca.find_next_correlation('AKT1', 't', 'akt1')
+        assert multi_ca.find_causality_targets({'id': 'MAPK1', 'rel': 'phosphorylates'}) == \
+            ca.find_causality_targets({'id': 'MAPK1', 'rel': 'phosphorylates'})
+        try:
+            multi_ca.find_next_correlation('AKT1', 's', 'missing')
+            assert False
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(build_dir)
+
+
+def test_connection_pool():
+    build_dir = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(build_dir, 'network.db')
+        other_file = os.path.join(build_dir, 'other.db')
+        for file_path, value in ((db_file, 1), (other_file, 2)):
+            cadb = sqlite3.connect(file_path)
+            cadb.execute("CREATE TABLE Value(Value INTEGER)")
+            cadb.execute("INSERT INTO Value VALUES(?)", (value,))
+            cadb.commit()
+            cadb.close()
+        pool = causality_agent.ConnectionPool(db_file)
+
+        # Each thread queries through a connection of its own
+        start = threading.Event()
+        results = {}
+
+        def query(ind):
+            start.wait(5)
+            cadb = pool.get()
+            results[ind] = (cadb, cadb.execute("SELECT Value FROM Value").fetchone()[0], pool.get() is cadb)
+
+        threads = [threading.Thread(target=query, args=(ind,)) for ind in range(4)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join(5)
+        assert len(set(id(cadb) for cadb, _, _ in results.values())) == 4
+        assert all(value == 1 and reused for _, value, reused in results.values())
+
+        cadb = pool.get()
+        pool.refresh()
+        refreshed = pool.get()
+        assert refreshed is not cadb
+        pool.attach('other', other_file)
+        attached = pool.get()
+        assert attached is not refreshed
+        assert attached.execute("SELECT Value FROM other.Value").fetchone()[0] == 2
+        pool.close()
+        assert pool.connections == []
+    finally:
+        shutil.rmtree(build_dir)
+
+
+def test_lazy_agent_ready():
+    lazy_ca = causality_agent.CausalityAgent(_resource_dir, lazy=True)
+    assert lazy_ca.wait_ready(timeout=600)
+    assert lazy_ca.table_ready('Causality', 'MutSig', 'Sif_Relations')
+    assert lazy_ca.find_causality_targets({'id': 'AKT1', 'rel': 'phosphorylates'}) == \
+        ca.find_causality_targets({'id': 'AKT1', 'rel': 'phosphorylates'})
+
+
+def test_correlation_cursors_per_gene_and_session():
+    ca.reset_cursors()
+    first_akt = ca.find_next_correlation('AKT1', 'session1')
+    ca.find_next_correlation('BRAF', 'session1')
+    second_akt = ca.find_next_correlation('AKT1', 'session1')
+    assert second_akt != first_akt
+    assert ca.find_next_correlation('AKT1', 'session2') == first_akt
+    ca.reset_cursors('session1')
+    assert ca.find_next_correlation('AKT1', 'session1') == first_akt
+
+
+def test_correlation_cursors_bounded():
+    ca.reset_cursors()
+    max_cursors = ca.max_cursors
+    ca.max_cursors = 2
+    try:
+        for gene in ('AKT1', 'BRAF', 'AKT1', 'MAPK1'):
+            ca.find_next_correlation(gene, 'bounded')
+        genes = [key[2] for key in ca.cursors]
+        assert genes == ['AKT1', 'MAPK1']
+    finally:
+        ca.max_cursors = max_cursors
+        ca.reset_cursors()
+
+
+def test_next_ranked_query_uses_index():
+    for after, args in ((False, ('AKT1', 0)), (True, ('AKT1', 0, 0.5, 0.5, 3))):
+        plan = ca.select("EXPLAIN QUERY PLAN " + causality_agent._next_ranked_query('pnnl', after), args)
+        details = ' '.join(row[-1] for row in plan)
+        assert 'USING INDEX Ranked_Gene' in details
+        assert 'TEMP B-TREE' not in details and 'MULTI-INDEX' not in details
+
+
+def test_targets_page_query_uses_index():
+    param = {'id': 'MAPK1', 'rel': 'phosphorylates'}
+    for after in (None, 7, 8):
+        query, args = causality_agent._ordered_targets_query(param, after, "IndraJson IS NOT NULL")
+        plan = ca.select("EXPLAIN QUERY PLAN " + query + " LIMIT ?", args + (3,))
+        details = ' '.join(row[-1] for row in plan)
+        assert 'USING INDEX Causality_Relations_Id1_Rel' in details
+        assert 'USING INDEX Causality_Relations_Id2_Rel' in details
+        assert 'TEMP B-TREE' not in details
+
+
+def test_find_causality_targets_many():
+    res = ca.find_causality_targets_many(['MAPK1', 'BRAF'], 'phosphorylates')
+    assert set(res.keys()) == {'MAPK1', 'BRAF'}
+    assert res['MAPK1'] == ca.find_causality_targets({'id': 'MAPK1',
+                                                      'rel': 'phosphorylates'})
+
+
+def test_find_causality_targets_paged():
+    param = {'id': 'MAPK1', 'rel': 'phosphorylates'}
+    targets = ca.find_causality_targets(param)
+    assert [len(chunk) for chunk in ca.iter_causality_targets(param, chunk_size=2)][0] == 2
+
+    for param in [{'id': 'MAPK1', 'rel': 'phosphorylates'}, {'id': 'MAPK1', 'rel': 'is-phosphorylated-by'},
+                  {'id': 'MAPK1', 'rel': 'modulates'}, {'id': ['MAPK1', 'BRAF'], 'rel': 'phosphorylates'}]:
+        query, args = causality_agent._causality_query("*", causality_agent._targets_filter(param))
+        targets = [ca.row_to_causality(row) for row in ca.select(query + " ORDER BY Seq", args)]
+        assert ca.find_causality_targets(param) == targets
+        for find_page, expected in ((ca.find_causality_targets_page, targets),
+                                    (ca.find_causality_targets_indra_page,
+                                     ca.find_causality_targets_indra(param))):
+            paged = []
+            page_token = None
+            while True:
+                page = find_page(dict(param, pageSize=2, pageToken=page_token))
+                assert page['total'] == len(expected)
+                assert len(page['targets']) <= 2
+                paged += page['targets']
+                page_token = page['nextPageToken']
+                if page_token is None:
+                    break
+            assert paged == expected
+
+    for invalid in [{'pageSize': -1}, {'pageSize': 'x'}, {'pageToken': 'abc'}]:
+        try:
+            ca.find_causality_targets_page(dict(param, **invalid))
+            assert False
+        except ValueError:
+            pass
+
+
+def test_find_mut_sig_many():
+    res = ca.find_mut_sig_many(['TP53', 'BRCA1'])
+    assert res == {'TP53': ca.find_mut_sig('TP53'),
+                   'BRCA1': ca.find_mut_sig('BRCA1')}
+
+
+def test_find_mut_sig_unknown():
+    assert ca.find_mut_sig('TP53') == 'highly significant'
+    assert ca.find_mut_sig('NOT-A-GENE') == 'unknown'
+    assert ca.find_mut_sig_many(['NOT-A-GENE']) == {'NOT-A-GENE': 'unknown'}
+
+
+def test_mut_sig_loaded_at_startup():
+    index = ca.mut_sig_index
+    assert index is not None
+    ca.find_mut_sig('TP53')
+    assert ca.mut_sig_index is index
+
+
+def test_find_mutex_top_k():
+    groups = ca.find_mutex('TP53')
+    assert groups
+    scores = [group['score'] for group in groups]
+    assert scores == sorted(scores)
+    assert all('TP53' in group['group'] and None not in group['group'] for group in groups)
+    assert ca.find_mutex('TP53', k=1) == groups[:1]
+    many = ca.find_mutex_many(['TP53', 'CDH1', 'NOT-A-GENE'], k=2)
+    assert many['TP53'] == groups[:2]
+    assert many['CDH1'] == ca.find_mutex('CDH1', k=2)
+    assert many['NOT-A-GENE'] == []
+
+
+def test_add_dataset():
+    build_dir = make_build_dir()
+    try:
+        lines = akt1_correlation_lines(build_dir)
+
+        built = []
+        upload_ca = causality_agent.CausalityAgent(build_dir, lazy=True,
+                                                   on_ready=lambda: built.append(True))
+        # A dataset failing while the network is built leaves the build going
+        failed = upload_ca.add_dataset('missing', 'missing-correlations.txt')
+        ready = []
+        thread = upload_ca.add_dataset('upload', lines=iter(lines), on_ready=ready.append)
+        try:
+            upload_ca.add_dataset('upload', 'PNNL-ovarian-correlations.txt')
+            assert False
+        except ValueError:
+            pass
+        for file_name in ['/etc/passwd', '../PNNL-ovarian-correlations.txt', '..', 'a\\b.txt']:
+            try:
+                upload_ca.add_dataset('outside', file_name)
+                assert False
+            except ValueError:
+                pass
+        assert upload_ca.dataset_status('outside') is None
+        thread.join(600)
+        failed.join(600)
+        assert ready == ['upload']
+        assert upload_ca.dataset_status('upload') == 'ready'
+        assert upload_ca.dataset_status('missing') == 'failed'
+        assert upload_ca.wait_ready(timeout=600)
+        upload_ca.build_thread.join(600)
+        assert built == [True]
+        assert upload_ca.find_next_correlation('AKT1', 's', 'upload')['id1'] == 'AKT1'
+        assert upload_ca.select("SELECT COUNT(*), SUM(Explained) FROM upload.Correlations") == \
+            upload_ca.select("SELECT COUNT(*), SUM(Explained) FROM pnnl.Correlations WHERE Id1 = 'AKT1'")
+
+        # Dataset names are quoted in the SQL, so keywords are valid names
+        upload_ca.add_dataset('order', lines=iter(lines)).join(600)
+        assert upload_ca.dataset_status('order') == 'ready'
+        assert upload_ca.find_next_correlation('AKT1', 's', 'order') == \
+            upload_ca.find_next_correlation('AKT1', 't', 'upload')
+        assert upload_ca.find_causality({'source': {'id': 'MAPK1'}, 'target': {'id': 'JUND'}})
+        try:
+            upload_ca.find_next_correlation('AKT1', 's', 'missing')
+            assert False
+        except ValueError:
+            pass
+        assert upload_ca.list_datasets() == ['order', 'pnnl', 'upload']
+    finally:
+        shutil.rmtree(build_dir)
+
+
+def test_failed_build():
+    build_dir = make_build_dir()
+    try:
+        os.remove(os.path.join(build_dir, 'causative-data-centric.sif'))
+        failed_ca = causality_agent.CausalityAgent(build_dir, lazy=True)
+        assert not failed_ca.wait_ready()
+        failed_ca.build_thread.join(600)
+        assert failed_ca.build_error
+        assert failed_ca.build_failed('Causality')
+        assert failed_ca.dataset_status('pnnl') == 'failed'
+        # Datasets added later fail rather than wait for the Causality table
+        thread = failed_ca.add_dataset('upload', lines=iter(akt1_correlation_lines(build_dir)))
+        thread.join(600)
+        assert not thread.is_alive()
+        assert failed_ca.dataset_status('upload') == 'failed'
+    finally:
+        shutil.rmtree(build_dir)
+
+
+def test_parallel_build_matches_serial():
+    serial_dir = make_build_dir()
+    parallel_dir = make_build_dir()
+    chunk_size = causality_agent._build_chunk_size
+    try:
+        serial_ca = causality_agent.CausalityAgent(serial_dir)
+        causality_agent._build_chunk_size = 4096
+        parallel_ca = causality_agent.CausalityAgent(parallel_dir, build_processes=3)
+        for table in ['Causality_Relations', 'Provenance_Uris', 'Correlations', 'MutSig',
+                      'Sif_Relations', 'Mutex_Groups']:
+            query = "SELECT * FROM %s ORDER BY rowid" % table
+            assert parallel_ca.select(query) == serial_ca.select(query)
+    finally:
+        causality_agent._build_chunk_size = chunk_size
+        shutil.rmtree(serial_dir)
+        shutil.rmtree(parallel_dir)
+
+
+def _build_in_process(build_dir):
+    causality_agent.CausalityAgent(build_dir)
+
+
+def test_concurrent_process_builds():
+    build_dir = make_build_dir()
+    try:
+        processes = [multiprocessing.Process(target=_build_in_process, args=(build_dir,))
+                     for _ in range(2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(600)
+        assert [process.exitcode for process in processes] == [0, 0]
+        assert not [name for name in os.listdir(build_dir) if name.endswith('.tmp')]
+        build_ca = causality_agent.CausalityAgent(build_dir)
+        assert build_ca.select("PRAGMA integrity_check") == [('ok',)]
+        assert build_ca.list_datasets() == ['pnnl']
+        assert build_ca.find_causality_targets({'id': 'MAPK1', 'rel': 'phosphorylates'}) == \
+            ca.find_causality_targets({'id': 'MAPK1', 'rel': 'phosphorylates'})
+    finally:
+        shutil.rmtree(build_dir)
+
+
+def test_read_lines_chunks():
+    with tempfile.NamedTemporaryFile('w', delete=False) as fp:
+        fp.write('a\nbb\n\nccc\nd')
+    try:
+        for chunk_size in range(1, 12):
+            lines = [line for start, end in causality_agent._chunk_ranges(fp.name, chunk_size)
+                     for line in causality_agent._read_lines(fp.name, start, end)]
+            assert lines == ['a\n', 'bb\n', '\n', 'ccc\n', 'd']
+    finally:
+        os.remove(fp.name)
+
+
+def test_parsed_chunks_window():
+    with tempfile.NamedTemporaryFile('w', delete=False) as fp:
+        fp.writelines('%d\t0.0\tG%d\n' % (i, i) for i in range(100))
+    chunk_size = causality_agent._build_chunk_size
+    pool = multiprocessing.Pool(2)
+    try:
+        causality_agent._build_chunk_size = 64
+        chunks = causality_agent._ParsedChunks(pool, causality_agent._mutex_rows, fp.name, 3)
+        rows = []
+        for row in chunks:
+            assert len(chunks.jobs) <= 3
+            rows.append(row)
+        with open(fp.name) as lines:
+            assert rows == list(causality_agent._mutex_rows(lines))
+    finally:
+        causality_agent._build_chunk_size = chunk_size
+        pool.terminate()
+        os.remove(fp.name)
+
+
+def test_term_name_cache_lru():
+    cache = TermNameCache(max_size=2)
+    cache.put(TermNameCache.key('<ekb>a</ekb>'), 'A')
+    cache.put(TermNameCache.key('<ekb>b</ekb>'), 'B')
+    assert cache.get(TermNameCache.key('<ekb>a</ekb>')) == (True, 'A')
+    cache.put(TermNameCache.key('<ekb>c</ekb>'), 'C')
+    assert cache.get(TermNameCache.key('<ekb>b</ekb>')) == (False, None)
+    assert cache.get(TermNameCache.key(' <ekb>a</ekb>\n')) == (True, 'A')
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_term_name_cache_ttl():
+    cache = TermNameCache(ttl=0)
+    cache.put(TermNameCache.key('<ekb>a</ekb>'), 'A')
+    time.sleep(0.01)
+    assert cache.get(TermNameCache.key('<ekb>a</ekb>')) == (False, None)
+
+
 class TestCausalPath(_IntegrationTest):
     def __init__(self, *args):
         super(TestCausalPath, self).__init__(CausalityModule)
@@ -133,7 +611,6 @@ class TestCausalitySource(_IntegrationTest):
 # ca.find_next_correlation('AKT1',print_result)
 # # ca.find_next_correlation('AKT1',print_result)
 # ca.find_correlation_between('AKT1', 'BRAF')
-# ca.find_all_correlations('AKT1')
 # print(ca.find_mut_sig('TP53'))
 # ca.find_common_upstreams('RAC1', 'RAC2')
 # ca.find_common_upstreams(['AKT1', 'BRAF', 'MAPK1'], print_result)
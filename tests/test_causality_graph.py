@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import causality_graph as graph_module
+from causality_graph import SifGraph, CausalityGraph, MutSigIndex
+
+rows = [('PAK1', 'RAC1', 'controls-state-change-of'),
+        ('PAK1', 'RAC2', 'controls-state-change-of'),
+        ('PAK1', 'AKT1', 'controls-state-change-of'),
+        ('SRC', 'RAC1', 'controls-state-change-of'),
+        ('SRC', 'RAC2', 'controls-state-change-of'),
+        ('SRC', 'RAC2', 'controls-state-change-of'),
+        ('MTOR', 'AKT1', 'controls-expression-of'),
+        ('MTOR', 'RAC1', 'controls-expression-of')]
+graph = SifGraph(rows)
+
+
+def test_common_upstreams_two_genes():
+    assert graph.find_common_upstreams(['RAC1', 'RAC2']) == ['PAK1', 'SRC']
+
+
+def test_common_upstreams_three_genes():
+    assert graph.find_common_upstreams(['RAC1', 'RAC2', 'AKT1']) == ['PAK1']
+
+
+def test_common_upstreams_by_rel():
+    assert graph.find_common_upstreams(['RAC1', 'AKT1'],
+                                       'controls-expression-of') == ['MTOR']
+
+
+def test_common_upstreams_unknown_gene():
+    assert graph.find_common_upstreams(['RAC1', 'XYZ']) == []
+
+
+causality_rows = [('PRKCD', 'T141T', 'GSK3B', 'S9S', 'phosphorylates', ''),
+                  ('GSK3B', 'S9S', 'HSF1', 'S303S', 'phosphorylates', ''),
+                  ('PRKCD', 'T141T', 'ADD1', 'S726S', 'phosphorylates', ''),
+                  ('ADD1', 'S726S', 'GSK3B', 'S9S', 'phosphorylates', ''),
+                  ('HSF1', 'S303S', 'PRKCD', 'T141T', 'phosphorylates', '')]
+causality_graph = CausalityGraph(causality_rows)
+
+
+def test_causal_paths_shortest_first():
+    paths = causality_graph.find_paths(['PRKCD'], ['HSF1'])
+    assert [[row[0] for row in path] for path in paths] == \
+        [['PRKCD', 'GSK3B'], ['PRKCD', 'ADD1', 'GSK3B']]
+
+
+def test_causal_paths_hop_limit():
+    assert causality_graph.find_paths(['PRKCD'], ['HSF1'], max_hops=1) == []
+
+
+def test_causal_paths_max_paths():
+    assert len(causality_graph.find_paths(['PRKCD'], ['HSF1'], max_paths=1)) == 1
+
+
+def test_mut_sig_index_first_row_wins():
+    index = MutSigIndex([('TP53', 'highly significant'), ('KRAS', 'significant'),
+                         ('TP53', 'not significant')])
+    assert index.levels == {'TP53': 'highly significant', 'KRAS': 'significant'}
+
+
+class BlockedIndex(MutSigIndex):
+    """MutSigIndex loading only once released"""
+    loading = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, rows):
+        self.loading.set()
+        self.release.wait(5)
+        super(BlockedIndex, self).__init__(rows)
+
+
+def test_graph_loads_do_not_block_each_other():
+    fd, db_file = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        cadb = sqlite3.connect(db_file)
+        cadb.execute("CREATE TABLE MutSig(Id TEXT, Level TEXT)")
+        cadb.execute("INSERT INTO MutSig VALUES('TP53', 'highly significant')")
+        cadb.commit()
+        cadb.close()
+        query = "SELECT Id, Level FROM MutSig ORDER BY rowid"
+        blocked = threading.Thread(target=graph_module._get_graph, args=(db_file, BlockedIndex, query))
+        blocked.start()
+        try:
+            assert BlockedIndex.loading.wait(5)
+            index = graph_module._get_graph(db_file, MutSigIndex, query)
+            assert index.levels == {'TP53': 'highly significant'}
+            assert blocked.is_alive()
+        finally:
+            BlockedIndex.release.set()
+            blocked.join(5)
+    finally:
+        os.remove(db_file)
@@ -0,0 +1,48 @@
+import logging
+from causality_metrics import Metrics
+
+
+def test_task_spans_and_sql():
+    metrics = Metrics(buckets=(0.5, 1.0), slow_query_threshold=10)
+    with metrics.task('FIND-CAUSAL-PATH'):
+        with metrics.span('trips'):
+            pass
+        metrics.sql('SELECT 1', 0.7, 3)
+    assert metrics.counters[('causality_requests_total',
+                             (('status', 'success'), ('task', 'FIND-CAUSAL-PATH')))] == 1
+    assert metrics.counters[('causality_sql_rows_total', (('task', 'FIND-CAUSAL-PATH'),))] == 3
+    sql = metrics.histograms[('causality_span_seconds', (('span', 'sql'), ('task', 'FIND-CAUSAL-PATH')))]
+    assert sql[:2] == [0, 1]
+    assert sql[-1] == 1
+    assert metrics.current_task() == ''
+
+
+def test_failed_task_counted():
+    metrics = Metrics()
+    try:
+        with metrics.task('GET-METRICS'):
+            raise ValueError()
+    except ValueError:
+        pass
+    assert metrics.counters[('causality_requests_total',
+                             (('status', 'failure'), ('task', 'GET-METRICS')))] == 1
+
+
+def test_slow_query_logged(caplog):
+    metrics = Metrics(slow_query_threshold=0.01)
+    with caplog.at_level(logging.WARNING, logger='CausalityMetrics'):
+        metrics.sql('SELECT *\n  FROM Causality', 0.001, 1)
+        metrics.sql('SELECT *\n  FROM Causality', 0.02, 1)
+    assert len(caplog.records) == 1
+    assert 'SELECT * FROM Causality' in caplog.records[0].getMessage()
+
+
+def test_prometheus_format():
+    metrics = Metrics(buckets=(0.1,))
+    with metrics.task('findMutSigMany'):
+        pass
+    text = metrics.to_prometheus()
+    assert '# TYPE causality_requests_total counter' in text
+    assert 'causality_requests_total{status="success",task="findMutSigMany"} 1' in text
+    assert 'causality_request_seconds_bucket{task="findMutSigMany",le="+Inf"} 1' in text
+    assert 'causality_request_seconds_count{task="findMutSigMany"} 1' in text
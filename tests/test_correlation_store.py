@@ -0,0 +1,31 @@
+import pytest
+from causality_sbgnviz_interface import _resource_dir
+import causality_agent
+
+pytest.importorskip('numpy')
+
+ca = causality_agent.CausalityAgent(_resource_dir)
+store_ca = causality_agent.CausalityAgent(_resource_dir, use_correlation_store=True)
+
+
+def test_store_opened():
+    assert store_ca.correlation_stores.get('pnnl') is not None
+
+
+def test_next_correlation_matches_sqlite():
+    for gene in ['AKT1', 'MAPK1', 'BRAF']:
+        for i in range(20):
+            assert store_ca.find_next_correlation(gene, 'store') == \
+                ca.find_next_correlation(gene, 'store')
+
+
+def test_correlation_between_matches_sqlite():
+    for gene in ['AKT1', 'MAPK1']:
+        for i in range(5):
+            row = ca.next_ranked_correlation(gene, False, 'between')
+            if row is None:
+                break
+            assert store_ca.get_correlation_between(*row[:4]) == \
+                ca.get_correlation_between(*row[:4])
+            assert store_ca.get_correlation_between(row[2], row[3], row[0], row[1]) != ''
+    assert store_ca.get_correlation_between('NOGENE', 'S1s', 'AKT1', 'S473s') == ''
@@ -0,0 +1,179 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from causality_sbgnviz_async import CausalitySbgnvizAsyncInterface
+
+
+class StandInClient(object):
+    """Stand-in for the SBGNViz Socket.IO server, seen through the client
+    interface of socketio.AsyncClient"""
+    def __init__(self, server):
+        self.server = server
+        self.handlers = {}
+        self.closed = asyncio.Event()
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+
+    async def connect(self, url):
+        self.server.connects += 1
+        if self.server.connects <= self.server.failed_connects:
+            raise ConnectionError('Connection refused')
+        self.server.clients.append(self)
+
+    async def call(self, event, data=None):
+        assert event == 'agentCurrentRoomRequest'
+        return self.server.room
+
+    async def emit(self, event, data=None):
+        self.server.emitted.append((event, data))
+
+    async def wait(self):
+        await self.closed.wait()
+
+    async def disconnect(self):
+        self.closed.set()
+
+
+class StandInServer(object):
+    def __init__(self, room='room1', failed_connects=0):
+        self.room = room
+        self.failed_connects = failed_connects
+        self.connects = 0
+        self.clients = []
+        self.emitted = []
+
+    def client(self):
+        return StandInClient(self)
+
+    async def send(self, event, params):
+        """Emit an event to the agent and return its callback value"""
+        return await self.clients[-1].handlers[event](params)
+
+
+class StandInAgent(object):
+    def __init__(self):
+        self.reset_sessions = []
+
+    def find_causality_targets(self, params):
+        return [{'id1': params['id'], 'rel': params['rel'], 'uri_ids': [1, 2]}]
+
+    def find_causality_targets_page(self, params):
+        if params['pageSize'] < 1:
+            raise ValueError('Invalid page size: %d' % params['pageSize'])
+        return {'targets': [], 'total': 0, 'nextPageToken': None}
+
+    def add_provenance(self, causalities):
+        for causality in causalities:
+            causality['uri_str'] = ''.join('uri= u%d&' % uri_id for uri_id in causality['uri_ids'])
+        return causalities
+
+    def find_next_correlation(self, gene, session_id, dataset=None):
+        if dataset is not None:
+            raise ValueError('Unknown dataset: %s' % dataset)
+        return {'id1': gene, 'session': session_id}
+
+    def add_dataset(self, name, correlation_file=None, lines=None):
+        if name == 'pnnl':
+            raise ValueError('Dataset already exists: pnnl')
+        self.lines = lines
+
+    def dataset_status(self, name):
+        return 'building'
+
+    def reset_cursors(self, session_id=None):
+        self.reset_sessions.append(session_id)
+
+
+def run_with_interface(server, test):
+    async def run():
+        interface = CausalitySbgnvizAsyncInterface(
+            StandInAgent(), ThreadPoolExecutor(2), client_factory=server.client,
+            min_backoff=0.01)
+        task = asyncio.ensure_future(interface.run())
+        while not server.clients:
+            await asyncio.sleep(0.01)
+        try:
+            return await test(interface)
+        finally:
+            await interface.stop()
+            await task
+    return asyncio.run(run())
+
+
+def test_subscribes_to_current_room():
+    server = StandInServer()
+
+    async def test(interface):
+        return interface.room_id
+
+    assert run_with_interface(server, test) == 'room1'
+    assert server.emitted[0][0] == 'subscribeAgent'
+    assert server.emitted[0][1]['room'] == 'room1'
+
+
+def test_events_answered_through_executor():
+    server = StandInServer()
+
+    async def test(interface):
+        targets = await server.send('findCausalityTargets',
+                                    {'id': 'MAPK1', 'rel': 'phosphorylates'})
+        corr = await server.send('findCorrelation', 'AKT1')
+        return targets, corr
+
+    targets, corr = run_with_interface(server, test)
+    assert targets == [{'id1': 'MAPK1', 'rel': 'phosphorylates', 'uri_ids': [1, 2],
+                        'uri_str': 'uri= u1&uri= u2&'}]
+    assert corr == {'id1': 'AKT1', 'session': 'room1'}
+
+
+def test_invalid_page_answered_with_error():
+    server = StandInServer()
+
+    async def test(interface):
+        return await server.send('findCausalityTargetsPage', {'id': 'MAPK1', 'rel': 'phosphorylates',
+                                                              'pageSize': -1})
+
+    assert run_with_interface(server, test) == {'error': 'Invalid page size: -1'}
+
+
+def test_failed_event_answered_with_error():
+    server = StandInServer()
+
+    async def test(interface):
+        return await server.send('findCorrelation', {'gene': 'AKT1', 'dataset': 'missing'})
+
+    assert run_with_interface(server, test) == {'error': 'Failed to handle findCorrelation'}
+
+
+def test_load_dataset_content():
+    server = StandInServer()
+
+    async def test(interface):
+        loaded = await server.send('loadDataset', {'name': 'upload', 'content': 'a\tb\n'})
+        taken = await server.send('loadDataset', {'name': 'pnnl', 'file': 'pnnl.txt'})
+        return loaded, taken, interface.CA.lines
+
+    loaded, taken, lines = run_with_interface(server, test)
+    assert loaded == {'name': 'upload', 'status': 'building'}
+    assert taken == {'name': 'pnnl', 'error': 'Dataset already exists: pnnl'}
+    assert lines == ['a\tb\n']
+
+
+def test_reconnects_after_failures():
+    server = StandInServer(failed_connects=3)
+
+    async def test(interface):
+        return interface.room_id
+
+    assert run_with_interface(server, test) == 'room1'
+    assert server.connects == 4
+
+
+def test_stop_resets_room_cursors():
+    server = StandInServer()
+
+    async def test(interface):
+        return interface
+
+    interface = run_with_interface(server, test)
+    assert interface.CA.reset_sessions == ['room1']
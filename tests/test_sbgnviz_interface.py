@@ -0,0 +1,40 @@
+import threading
+from causality_sbgnviz_interface import RequestDispatcher
+
+
+def test_dispatcher_runs_handlers():
+    dispatcher = RequestDispatcher(max_workers=2, max_queue=8)
+    results = []
+    done = threading.Event()
+
+    def callback(res):
+        results.append(res)
+        if len(results) == 3:
+            done.set()
+
+    for i in range(3):
+        assert dispatcher.submit('square', lambda x: x * x, i, callback)
+    assert done.wait(5)
+    assert sorted(results) == [0, 1, 4]
+    assert dispatcher.get_metrics()['square']['completed'] == 3
+    dispatcher.stop()
+
+
+def test_dispatcher_rejects_when_full():
+    dispatcher = RequestDispatcher(max_workers=1, max_queue=1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block(params):
+        started.set()
+        release.wait(5)
+
+    assert dispatcher.submit('block', block, None, lambda res: None)
+    assert started.wait(5)
+    assert dispatcher.submit('block', block, None, lambda res: None)
+    assert not dispatcher.submit('block', block, None, lambda res: None)
+    metrics = dispatcher.get_metrics()['block']
+    assert metrics['rejected'] == 1
+    assert metrics['max_queued'] == 1
+    release.set()
+    dispatcher.stop()